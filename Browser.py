@@ -1,6 +1,7 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 # execute in production with: nohup python3 Browser.py &> browser.log < /dev/null &
+# together with the indexer: nohup python3 -m indexer &> indexer.log < /dev/null &
 
 ################
 # Logging init #
@@ -16,25 +17,28 @@ with open('logging.json', 'r') as f:
 ###########
 import re
 import sys
-import os
 import requests
-import struct
 
-from time import sleep
-
-from rpc_client import get_acct_raw, get_acct_info, start_rpc_client_instance
-from db_funcs import get_latest_version, TxDBWorker
+from rpc_client import get_acct_raw_coalesced, get_acct_info, get_tx_program, wait_for_rpc_client_instance
+from db_funcs import get_latest_version, use_latest_version_file, get_acct_txs, get_acct_events, acct_changed_since, \
+    bind_session
 from stats import calc_stats
-from models import Transaction, session_scope
-from sqlalchemy import desc, func
+from models import Transaction, Script, session_scope
+from settings import load_config
+from render import Template
+from scripts import split_program, render_program
+import acct_cache
 
 ##############
 # Flask init #
 ##############
-from flask import Flask, request, redirect, send_from_directory
+from flask import Flask, Response, request, redirect, send_from_directory, stream_with_context
 from flask_caching import Cache
 
-cache = Cache(config={'CACHE_TYPE': 'simple', 'CACHE_DEFAULT_TIMEOUT': 60})  # TODO: simple cache is not thread safe
+config = load_config()
+
+# CACHE_* settings select the backend, see cache_backends.py
+cache = Cache(config={k: v for k, v in config.items() if k.startswith('CACHE_')})
 app = Flask(__name__, static_url_path='')
 cache.init_app(app)
 
@@ -44,31 +48,47 @@ cache.init_app(app)
 ###############
 ctr = 0   # counter of requests since last init
 
-with open('templates/index.tmpl.html', 'r', encoding='utf-8') as f:
-    index_template = f.read()
-
-with open('templates/version.tmpl.html', 'r', encoding='utf-8') as f:
-    version_template = f.read()
-
-with open('templates/forbidden.tmpl.html', 'r', encoding='utf-8') as f:
-    forbidden_template = f.read()
-
-with open('templates/stats.tmpl.html', 'r', encoding='utf-8') as f:
-    stats_template = f.read()
-
-with open('templates/account.tmpl.html', 'r', encoding='utf-8') as f:
-    account_template = f.read()
-
-with open('templates/faucet.tmpl.html', 'r', encoding='utf-8') as f:
-    faucet_template = f.read()
-
-faucet_alert_template = '<div class="text-center"><div class="alert alert-danger" role="alert"><p>{0}</p></div></div>'
+index_template = Template.load('templates/index.tmpl.html')
+version_template = Template.load('templates/version.tmpl.html')
+forbidden_template = Template.load('templates/forbidden.tmpl.html')
+stats_template = Template.load('templates/stats.tmpl.html')
+account_template = Template.load('templates/account.tmpl.html')
+events_template = Template.load('templates/events.tmpl.html')
+faucet_template = Template.load('templates/faucet.tmpl.html')
+
+faucet_alert_template = Template('<div class="text-center"><div class="alert alert-danger" role="alert"><p>{0}</p></div></div>')
+
+tx_row_template = Template(
+    '<tr><td><a href="/version/{0}">{0}</a></td><td>{1}</td><td>{2}</td><td>'   # version, expiration date, type
+    '<p class="text-monospace"><a href="/account/{3}">{3}</a> &rarr; '           # source
+    '<a href="/account/{4}">{4}</a></p></td><td>'                                # dest
+    '<strong>{5} Libra</strong></td></tr>'                                       # amount
+)
+
+event_row_template = Template(
+    '<tr><td><a href="/version/{0}">{0}</a></td><td>{1}</td>'                # version, sequence number
+    '<td><p class="text-monospace">{2}</p></td><td><p class="text-monospace">{3}</p></td></tr>'  # path, data
+)
+
+raw_view_template = Template("""<tr>
+                        <td><strong>Program Raw</strong></td>
+                        <td><pre>{0}</pre></td>
+                        </tr>""")
 
 
 ################
 # Helper funcs #
 ################
-unpack = lambda x: struct.unpack('<Q', x)[0] / 1000000
+def init_services():
+    # per process setup, run once in every web worker before it serves requests
+    if config['LATEST_VERSION_FILE']:
+        use_latest_version_file(config['LATEST_VERSION_FILE'])
+    acct_cache.configure(config)
+    bind_session(config)
+    wait_for_rpc_client_instance(config)
+
+
+to_libra = lambda x: x / 1000000
 
 def update_counters():
     global ctr
@@ -85,17 +105,14 @@ def is_valid_account(acct):
 
 
 def gen_tx_table_row(tx):
-    res  = '<tr><td>'
-    res += '<a href="/version/' + str(tx.version) + '">' + str(tx.version) + '</a></td><td>'  # Version
-    res += str(tx.expiration_date) + '</td><td>'                                                 # expiration date
-    res += ('&#x1f91d;' if tx.type == 'peer_to_peer_transaction' else '&#x1f6e0;') + '</td><td>'   # type
-    res += '<p class="text-monospace">'
-    res += '<a href="/account/' + str(tx.src) + '">' + str(tx.src) + '</a> &rarr; '          # source
-    res += '<a href="/account/' + str(tx.dest) + '">' + str(tx.dest) + '</a></p></td><td>'  # dest
-    res += '<strong>' + str(unpack(tx.amount)) + ' Libra</strong></td>'                         # amount
-    res += '</tr>'
-
-    return res
+    return tx_row_template.render(
+        tx.version,
+        tx.expiration_date,
+        '&#x1f91d;' if tx.type == 'peer_to_peer_transaction' else '&#x1f6e0;',
+        tx.src,
+        tx.dest,
+        to_libra(tx.amount)
+    )
 
 
 def add_br_every64(s):
@@ -112,9 +129,9 @@ def add_br_every64(s):
 
 def gen_error_page(ver = None):
     try:
-        error = forbidden_template.format(ver)
+        error = forbidden_template.render(ver)
     except:
-        error = forbidden_template.format('???')
+        error = forbidden_template.render('???')
     return error
 
 
@@ -124,67 +141,75 @@ def gen_error_page(ver = None):
 @app.route('/')
 def index():
     update_counters()
-    with session_scope() as session:
-        bver = str(get_latest_version(session))
-    return index_template.format(bver)
+    bver = str(get_latest_version())
+    return index_template.render(bver)
 
 
 @app.route('/version/<ver>')
 @cache.cached(timeout=3600)  # versions don't change so we can cache long-term
 def version(ver):
     update_counters()
+    bver = str(get_latest_version())
     with session_scope() as session:
-
-        bver = str(get_latest_version(session))
-
         try:
             ver = int(ver)   # safety
         except:
-            logger.warning('potential attempt to inject: {}'.format(ver))
+            app.logger.warning('potential attempt to inject: {}'.format(ver))
             ver = 1
         res = session.query(Transaction).filter_by(version=ver).all()
         if 1 < len(res):
-            logger.warning('possible duplicates detected in db, record version: {}'.format(ver))
+            app.logger.warning('possible duplicates detected in db, record version: {}'.format(ver))
         try:
             tx = res.pop()
         except:
             return gen_error_page(bver), 404
 
+        script = session.query(Script).get(tx.script_hash) if tx.script_hash is not None else None
+        if script is not None:
+            code_hex, program = render_program(script.hash, script.code, tx.program_args)
+        else:
+            # ingested in light mode and not backfilled yet, or restored without its script
+            if tx.script_hash is not None:
+                app.logger.warning('script {} of version {} is missing'.format(tx.script_hash, tx.version))
+            program = get_tx_program(tx.version)
+            if program is not None:
+                code_hex, program = render_program(*split_program(program))
+            else:
+                app.logger.warning('program of version {} is not available from the ledger'.format(tx.version))
+                code_hex = program = 'program unavailable'
+
         # for toggle raw view
         if request.args.get('raw') == '1':
-            extra = """<tr>
-                        <td><strong>Program Raw</strong></td>
-                        <td><pre>{0}</pre></td>
-                        </tr>""".format(tx.code_hex)
+            extra = raw_view_template.render(code_hex)
             not_raw = '0'
         else:
             extra = ''
             not_raw = '1'
 
-        return version_template.format(
+        return version_template.render(
             bver,
             tx.version,
             tx.expiration_date,
             tx.src,
             tx.dest,
             tx.type,
-            unpack(tx.amount),
-            unpack(tx.gas_price),
-            unpack(tx.max_gas),
+            to_libra(tx.amount),
+            to_libra(tx.gas_price),
+            to_libra(tx.max_gas),
             tx.sq_num,
             tx.pub_key,
             tx.expiration_unixtime,
-            unpack(tx.gas_used),
+            to_libra(tx.gas_used),
             tx.sender_sig,
             tx.signed_tx_hash,
             tx.state_root_hash,
             tx.event_root_hash,
-            tx.code_hex,
-            tx.program,
+            code_hex,
+            program,
             add_br_every64(tx.sender_sig),
             extra,
             not_raw,
-            tx.code_hex.replace('<', '&lt;')
+            code_hex.replace('<', '&lt;')
         )
 
 
@@ -192,38 +217,75 @@ def version(ver):
 def acct_details(acct):
     update_counters()
     app.logger.info('Account: {}'.format(acct))
-    with session_scope() as session:
-        bver = str(get_latest_version(session))
+    bver = str(get_latest_version())
+
+    try:
+        before_version = int(request.args.get('before_version'))
+    except:
+        before_version = None
 
+    if not is_valid_account(acct):
+        return gen_error_page(bver), 404
+
+    try:
+        acct_state_raw = acct_cache.cache.get_or_fetch(acct, get_acct_raw_coalesced, acct_changed_since)
         try:
-            page = int(request.args.get('page'))
+            acct_info = get_acct_info(acct_state_raw)
         except:
-            page = 0
+            # if account_state_with_proof.blob does not exist
+            acct_info = (acct, 0, '-', 0, 0, None)
+        app.logger.info('acct_info: {}'.format(acct_info))
+    except:
+        app.logger.exception('error in fetching account state')
+        return gen_error_page(bver), 404
 
-        if not is_valid_account(acct):
-            return gen_error_page(bver), 404
+    # the header and balance go out right away, table rows follow as the db cursors yield them
+    oldest = None
 
-        try:
-            acct_state_raw = get_acct_raw(acct)
+    def tx_rows(session):
+        nonlocal oldest
+        for tx in get_acct_txs(session, acct, before_version):
+            oldest = tx.version
+            yield gen_tx_table_row(tx)
+
+    def next_page():
+        # keyset pagination: the next page starts below the oldest version shown
+        yield "/account/" + acct + ("?before_version=" + str(oldest) if oldest is not None else "")
+
+    def generate():
+        with session_scope() as session:
+            # GeneratorExit of a client disconnecting is not an error, it rolls back the session
             try:
-                acct_info = get_acct_info(acct_state_raw)
-            except:
-                # if account_state_with_proof.blob does not exist
-                acct_info = (acct, 0, '-', 0, 0, None)
-            app.logger.info('acct_info: {}'.format(acct_info))
-
-            tx_tbl = ''.join(gen_tx_table_row(tx) for tx in
-                session.query(Transaction).filter(
-                    (Transaction.src == acct) | (Transaction.dest == acct)
-                ).order_by(desc(Transaction.version)).limit(100).offset(page*100)
-            )
-        except:
-            app.logger.exception('error in building table')
-            return gen_error_page(bver), 404
+                yield from account_template.stream(bver, *(acct_info[:-1]), tx_rows(session), next_page())
+            except Exception:
+                app.logger.exception('error in building table')
+
+    return Response(stream_with_context(generate()))
+
+
+@app.route('/events/<acct>')
+def acct_events(acct):
+    update_counters()
+    app.logger.info('Events: {}'.format(acct))
+    bver = str(get_latest_version())
+
+    try:
+        before = (int(request.args.get('before_version')), int(request.args.get('before_index')))
+    except:
+        before = None
 
-    next_page = "/account/" + acct + "?page=" + str(page + 1)
+    if not is_valid_account(acct):
+        return gen_error_page(bver), 404
 
-    return account_template.format(bver, *(acct_info[:-1]), tx_tbl, next_page)
+    # events stored by the indexer, keyset paginated by (version, event_index)
+    with session_scope() as session:
+        events = get_acct_events(session, acct, before)
+        rows = [event_row_template.render(e.version, e.sequence_number, e.path, add_br_every64(e.data or ''))
+                for e in events]
+        next_page = '/events/' + acct + ('?before_version={}&before_index={}'.format(
+            events[-1].version, events[-1].event_index) if events else '')
+
+    return events_template.render(bver, acct, rows, next_page)
 
 
 @app.route('/search')
@@ -249,7 +311,7 @@ def stats():
             stats_24_hours = calc_stats(session, limit = 3600 * 24)[5:]
             stats_one_hour = calc_stats(session, limit = 3600)[5:]
 
-        ret = stats_template.format(*stats_all_time, *stats_24_hours, *stats_one_hour)
+        ret = stats_template.render(*stats_all_time, *stats_24_hours, *stats_one_hour)
     except:
         app.logger.exception('error in stats')
         try:
@@ -264,9 +326,7 @@ def stats():
 @app.route('/faucet', methods=['GET', 'POST'])
 def faucet():
     update_counters()
-    with session_scope() as session:
-
-        bver = str(get_latest_version(session))
+    bver = str(get_latest_version())
 
     message = ''
     if request.method == 'POST':
@@ -294,43 +354,28 @@ def faucet():
             app.logger.exception(message)
 
         if message:
-            message = faucet_alert_template.format(message)
+            message = faucet_alert_template.render(message)
 
-    return faucet_template.format(bver, message)
+    return faucet_template.render(bver, message)
 
 
 @app.route('/assets/<path:path>')
 @cache.cached(timeout=3600)  # assets don't really change so can be cached for one hour
 def send_asset(path):
-    return send_from_directory('assets', path)
+    # cache the file contents rather than the streaming response so any backend can pickle and replay it
+    response = send_from_directory('assets', path, conditional=False)
+    response.direct_passthrough = False
+    return response.get_data(), response.status_code, list(response.headers)
 
 
 ########
 # Main #
 ########
 if __name__ == '__main__':
-    with open('config.json', 'r') as f:
-        config = json.load(f)
-
-    try:
-        config = config[os.getenv("BROWSER")]
-    except:
-        config = config["PRODUCTION"]
-
     app.logger.info("system configuration: {}".format(json.dumps(config, indent=4)))
 
-    running = False
-    while not running:
-        try:
-            start_rpc_client_instance(config['RPC_SERVER'], config['MINT_ACCOUNT'])
-            running = True
-        except:
-            sleep(1)
-
-    txdb = TxDBWorker(config)
-    txdb.start()
-    while not txdb.running:
-        sleep(1)
+    # reads only, ingestion runs in its own process: python3 -m indexer
+    init_services()
 
     app.run(port=config['FLASK_PORT'], threaded=config['FLASK_THREADED'],
             host=config['FLASK_HOST'], debug=config['FLASK_DEBUG'])
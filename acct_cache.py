@@ -0,0 +1,98 @@
+# In-process cache of account state blobs served on /account
+
+##########
+# Logger #
+##########
+import logging
+logger = logging.getLogger(__name__)
+
+
+###########
+# Imports #
+###########
+from collections import OrderedDict
+from threading import Lock
+from time import monotonic
+
+
+#########
+# Cache #
+#########
+class AccountStateCache:
+    """LRU + TTL cache of GetAccountStateResponse keyed by account address.
+
+    Every entry remembers the ledger version it was read at. The db worker invalidates an
+    address when it ingests a transaction touching it at a later version, otherwise entries
+    expire after ttl seconds.
+    """
+    def __init__(self, max_entries=10000, ttl=10.0):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.lock = Lock()
+        self.entries = OrderedDict()  # acct -> (state, expires_at, ledger_version)
+        self.touched = OrderedDict()  # acct -> latest ingested version touching it
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, acct):
+        with self.lock:
+            entry = self.entries.get(acct)
+            if entry is None or entry[1] < monotonic():
+                self.misses += 1
+                return None
+            self.entries.move_to_end(acct)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, acct, state):
+        version = state.account_state_with_proof.version
+        with self.lock:
+            if self.touched.get(acct, -1) > version:
+                return  # answered before a transaction we already ingested, don't cache stale data
+            self.entries[acct] = (state, monotonic() + self.ttl, version)
+            self.entries.move_to_end(acct)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, touches):
+        # touches: iterable of (acct, version) from freshly committed transactions
+        with self.lock:
+            for acct, version in touches:
+                entry = self.entries.get(acct)
+                if entry is not None and entry[2] < version:
+                    del self.entries[acct]
+                if self.touched.get(acct, -1) < version:
+                    self.touched[acct] = version
+                    self.touched.move_to_end(acct)
+            while len(self.touched) > self.max_entries:
+                self.touched.popitem(last=False)
+
+    def get_or_fetch(self, acct, fetch, changed_since=None):
+        # changed_since(acct, version) lets a process without the db worker check for newer transactions
+        state = self.get(acct)
+        if state is not None and changed_since is not None \
+                and changed_since(acct, state.account_state_with_proof.version):
+            state = None
+        if state is None:
+            state = fetch(acct)
+            self.put(acct, state)
+        return state
+
+
+###########
+# Globals #
+###########
+cache = AccountStateCache()
+
+
+#########
+# Funcs #
+#########
+def configure(config):
+    cache.max_entries = config['ACCT_CACHE_SIZE']
+    cache.ttl = config['ACCT_CACHE_TTL']
+
+
+def invalidate_rows(rows):
+    # drop cached state of every src and dest of a batch of parsed transactions
+    cache.invalidate((acct, row['version']) for row in rows for acct in (row['src'], row['dest']))
@@ -0,0 +1,202 @@
+# Chunked columnar table archives, written and read in constant memory
+#
+# file    := MAGIC header chunk* footer trailer
+# MAGIC   := b'LBARCHV' u8 format version
+# header  := u32 length, json {"table", "columns": [[name, kind]], "key", "key_kind", "chunk_rows"}
+# chunk   := u32 length, zlib(u32 rows, column*)
+# column  := int / float: rows null flags, packed <q / <d values
+#            str / bytes / datetime: packed <i lengths (-1 is null), concatenated values
+# footer  := u32 chunks, per chunk: u64 offset, u32 length, u32 rows, i64 first key, i64 last key
+#            keys of another kind (e.g. script hashes): u32 length, column of the first and last key
+# trailer := u64 footer offset, MAGIC
+# keys are the leading primary key column (the version for the ledger tables)
+
+##########
+# Logger #
+##########
+import logging
+logger = logging.getLogger(__name__)
+
+
+###########
+# Imports #
+###########
+import json
+import struct
+import zlib
+from datetime import datetime
+
+from sqlalchemy import MetaData, Table, tuple_
+
+
+###########
+# Globals #
+###########
+MAGIC = b'LBARCHV\x01'
+INDEX_ENTRY = struct.Struct('<QIIqq')
+INDEX_POSITION = struct.Struct('<QII')  # of an index entry with keys that are not ints
+TRAILER = struct.Struct('<Q8s')
+KINDS = {int: 'int', float: 'float', str: 'str', bytes: 'bytes', datetime: 'datetime'}
+
+
+############
+# Encoding #
+############
+def encode_column(kind, values):
+    if kind in ('int', 'float'):
+        nulls = bytes(v is None for v in values)
+        packed = struct.pack('<{}{}'.format(len(values), 'q' if kind == 'int' else 'd'),
+                             *(0 if v is None else v for v in values))
+        return nulls + packed
+
+    if kind == 'str':
+        values = [None if v is None else v.encode('utf-8') for v in values]
+    elif kind == 'datetime':
+        values = [None if v is None else v.isoformat().encode('ascii') for v in values]
+    lengths = struct.pack('<{}i'.format(len(values)), *(-1 if v is None else len(v) for v in values))
+    return lengths + b''.join(v for v in values if v is not None)
+
+
+def decode_column(kind, buf, pos, rows):
+    # returns the values and the position after the column
+    if kind in ('int', 'float'):
+        nulls = buf[pos:pos + rows]
+        pos += rows
+        fmt = '<{}{}'.format(rows, 'q' if kind == 'int' else 'd')
+        values = struct.unpack_from(fmt, buf, pos)
+        pos += struct.calcsize(fmt)
+        return [None if null else v for null, v in zip(nulls, values)], pos
+
+    lengths = struct.unpack_from('<{}i'.format(rows), buf, pos)
+    pos += 4 * rows
+    values = []
+    for length in lengths:
+        if length < 0:
+            values.append(None)
+            continue
+        v = bytes(buf[pos:pos + length])
+        pos += length
+        if kind == 'str':
+            v = v.decode('utf-8')
+        elif kind == 'datetime':
+            v = datetime.fromisoformat(v.decode('ascii'))
+        values.append(v)
+    return values, pos
+
+
+def column_kind(column):
+    try:
+        return KINDS[column.type.python_type]
+    except (NotImplementedError, KeyError):
+        return 'str'
+
+
+#########
+# Write #
+#########
+def dump_table(engine, name, path, chunk_rows=10000):
+    # stream a table to an archive, one keyset page per chunk; returns the number of rows written
+    with engine.connect() as conn, open(path, 'wb') as f:
+        table = Table(name, MetaData(), autoload_with=conn)
+        columns = list(table.columns)
+        kinds = [column_kind(c) for c in columns]
+        key = list(table.primary_key.columns)
+        lead = columns.index(key[0])
+
+        header = json.dumps({'table': name, 'columns': [[c.name, k] for c, k in zip(columns, kinds)],
+                             'key': key[0].name, 'key_kind': kinds[lead], 'chunk_rows': chunk_rows}).encode('utf-8')
+        f.write(MAGIC)
+        f.write(struct.pack('<I', len(header)))
+        f.write(header)
+
+        index = []
+        total = 0
+        last = None
+        while True:
+            q = table.select().order_by(*key).limit(chunk_rows)
+            if last is not None:
+                q = q.where(tuple_(*key) > tuple_(*last)) if len(key) > 1 else q.where(key[0] > last[0])
+            rows = conn.execute(q).fetchall()
+            if not rows:
+                break
+
+            payload = [struct.pack('<I', len(rows))]
+            for i, kind in enumerate(kinds):
+                payload.append(encode_column(kind, [row[i] for row in rows]))
+            data = zlib.compress(b''.join(payload))
+
+            index.append((f.tell(), len(data), len(rows), rows[0][lead], rows[-1][lead]))
+            f.write(struct.pack('<I', len(data)))
+            f.write(data)
+
+            total += len(rows)
+            last = [rows[-1][columns.index(c)] for c in key]
+            logger.debug('{}: {} rows archived'.format(name, total))
+
+        footer_offset = f.tell()
+        f.write(struct.pack('<I', len(index)))
+        for entry in index:
+            if kinds[lead] == 'int':
+                f.write(INDEX_ENTRY.pack(*entry))
+                continue
+            keys = encode_column(kinds[lead], list(entry[3:]))
+            f.write(INDEX_POSITION.pack(*entry[:3]))
+            f.write(struct.pack('<I', len(keys)))
+            f.write(keys)
+        f.write(TRAILER.pack(footer_offset, MAGIC))
+    return total
+
+
+########
+# Read #
+########
+def read_header(f):
+    f.seek(0)
+    if f.read(len(MAGIC)) != MAGIC:
+        raise ValueError('not a table archive')
+    length, = struct.unpack('<I', f.read(4))
+    return json.loads(f.read(length).decode('utf-8'))
+
+
+def read_index(f):
+    # [(offset, length, rows, first key, last key)] from the footer
+    kind = read_header(f).get('key_kind', 'int')
+    f.seek(-TRAILER.size, 2)
+    footer_offset, magic = TRAILER.unpack(f.read(TRAILER.size))
+    if magic != MAGIC:
+        raise ValueError('archive is truncated, it has no index')
+    f.seek(footer_offset)
+    count, = struct.unpack('<I', f.read(4))
+    if kind == 'int':
+        return [INDEX_ENTRY.unpack(f.read(INDEX_ENTRY.size)) for _ in range(count)]
+
+    index = []
+    for _ in range(count):
+        position = INDEX_POSITION.unpack(f.read(INDEX_POSITION.size))
+        length, = struct.unpack('<I', f.read(4))
+        keys, _ = decode_column(kind, f.read(length), 0, 2)
+        index.append(position + tuple(keys))
+    return index
+
+
+def read_chunks(f, min_key=None, max_key=None):
+    # yields lists of row dicts, only chunks overlapping [min_key, max_key] are read
+    header = read_header(f)
+    names = [name for name, kind in header['columns']]
+    lead = header['key']
+    for offset, length, rows, first, last in read_index(f):
+        if (min_key is not None and last < min_key) or (max_key is not None and first > max_key):
+            continue
+        f.seek(offset + 4)
+        buf = memoryview(zlib.decompress(f.read(length)))
+        pos = 4
+        columns = []
+        for name, kind in header['columns']:
+            values, pos = decode_column(kind, buf, pos, rows)
+            columns.append(values)
+
+        chunk = [dict(zip(names, values)) for values in zip(*columns)]
+        if min_key is not None or max_key is not None:
+            chunk = [row for row in chunk if (min_key is None or row[lead] >= min_key)
+                     and (max_key is None or row[lead] <= max_key)]
+        yield chunk
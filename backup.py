@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Backup and restore of the ledger tables as chunked archives (see archive.py)
+# execute with: python3 backup.py dump transactions.lba
+#               python3 backup.py restore transactions.lba [--from-version N] [--to-version M]
+#               python3 backup.py prune archives/ledger --before 3000000
+
+################
+# Logging init #
+################
+import json
+from logging.config import dictConfig
+
+with open('logging.json', 'r') as f:
+    dictConfig( json.load(f) )
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+###########
+# Imports #
+###########
+import argparse
+import re
+
+from archive import dump_table, read_header, read_index, read_chunks
+from db_funcs import bind_session, insert_rows
+from models import Base, Transaction, Script, Event, session_scope
+from rollups import update_rollups
+from checkpoints import seed_checkpoints, trim_checkpoints
+from partitions import is_partitioned, detach_partitions, ensure_partitions
+from settings import load_config
+
+
+###########
+# Globals #
+###########
+MODELS = {model.__tablename__: model for model in (Transaction, Script, Event)}
+ARCHIVED_NAME = re.compile(r'(_old_\d+)?(_v\d+)?$')  # suffixes of tables replaced by a reset and of partitions
+PARTITION_NAME = re.compile(r'_v\d+$')  # archives written by prune
+
+
+#########
+# Funcs #
+#########
+def dump(engine, config, args):
+    rows = dump_table(engine, args.table, args.path, args.chunk)
+    logger.info('saved {} rows of {} to {}'.format(rows, args.table, args.path))
+
+
+def restore(engine, config, args):
+    # one transaction per chunk, so memory stays bounded by the chunk size
+    Base.metadata.create_all(engine)
+    partitions = {}
+    with open(args.path, 'rb') as f:
+        header = read_header(f)
+        # archives written after a testnet reset or of a partition are named after that table,
+        # e.g. transactions_old_<ts> or transactions_v<first version>
+        model = MODELS[args.table or ARCHIVED_NAME.sub('', header['table'])]
+        # pruned partitions are still counted in the stats rollups, other rows are folded in as they are restored
+        fold = model is Transaction and not PARTITION_NAME.search(header['table'])
+        total = 0
+        for rows in read_chunks(f, args.from_version, args.to_version):
+            if not rows:
+                continue
+            with session_scope() as session:
+                if 'version' in model.__table__.c and config['DB_PARTITION_SIZE']:
+                    # partitions pruned before are created again
+                    ensure_partitions(session.connection(), model.__tablename__, config['DB_PARTITION_SIZE'],
+                                      rows[0]['version'], rows[-1]['version'], partitions)
+                insert_rows(session, model, rows, args.method)
+                if fold:
+                    update_rollups(session, rows)
+            total += len(rows)
+            logger.info('restored {} rows into {}'.format(total, model.__tablename__))
+
+    if model is Transaction:
+        # the checkpoints are derived from the whole table
+        with session_scope() as session:
+            seed_checkpoints(session)
+
+
+def prune(engine, config, args):
+    # archive the transactions partitions below a version and drop them, their stats are kept
+    with engine.connect() as conn:
+        if not is_partitioned(conn, 'transactions'):
+            logger.error('transactions is not partitioned, see DB_PARTITION_SIZE')
+            return
+    floor = detach_partitions(engine, 'transactions', args.before, args.path)
+    if floor is None:
+        logger.info('no partition ends before version {}'.format(args.before))
+        return
+    with session_scope() as session:
+        trim_checkpoints(session, floor)
+    logger.info('transactions now start at version {}'.format(floor))
+
+
+def info(engine, config, args):
+    with open(args.path, 'rb') as f:
+        header = read_header(f)
+        index = read_index(f)
+    print('table: {}, columns: {}'.format(header['table'], ', '.join(name for name, kind in header['columns'])))
+    if index:
+        print('{} rows in {} chunks, {} {} to {}'.format(
+            sum(entry[2] for entry in index), len(index), header['key'], index[0][3], index[-1][4]))
+
+
+########
+# Main #
+########
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='backup and restore LibraBrowser tables')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    cmd = commands.add_parser('dump', help='stream a table to an archive')
+    cmd.add_argument('path')
+    cmd.add_argument('--table', default='transactions')
+    cmd.add_argument('--chunk', type=int, default=10000, help='rows per chunk')
+    cmd.set_defaults(func=dump)
+
+    cmd = commands.add_parser('restore', help='bulk insert an archive, or a range of versions of it')
+    cmd.add_argument('path')
+    cmd.add_argument('--table', help='restore into this table instead of the archived one')
+    cmd.add_argument('--from-version', type=int)
+    cmd.add_argument('--to-version', type=int)
+    cmd.add_argument('--method', default='auto', help='auto, copy, executemany or orm')
+    cmd.set_defaults(func=restore)
+
+    cmd = commands.add_parser('prune', help='archive and drop the transactions partitions below a version')
+    cmd.add_argument('path', help='prefix of the archives, one <path>_<partition>.lba per partition')
+    cmd.add_argument('--before', type=int, required=True, help='only partitions holding nothing but versions below it are pruned')
+    cmd.set_defaults(func=prune)
+
+    cmd = commands.add_parser('info', help='describe an archive')
+    cmd.add_argument('path')
+    cmd.set_defaults(func=info)
+
+    args = parser.parse_args()
+    if args.command == 'restore' and (args.from_version is not None or args.to_version is not None):
+        with open(args.path, 'rb') as f:
+            key = read_header(f)['key']
+        if key != 'version':
+            parser.error('--from-version and --to-version need an archive keyed by version, {} is keyed by {}'.format(
+                args.path, key))
+    config = load_config()
+    args.func(bind_session(config), config, args)
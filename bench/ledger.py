@@ -0,0 +1,193 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Stand-in AdmissionControl server for offline benchmarks
+# synthetic: python3 -m bench.ledger serve --port 50110 --versions 100000
+# record:    python3 -m bench.ledger record --server ac.testnet.libra.org:8000 --first 1 --last 100000 testnet.rec
+# replay:    python3 -m bench.ledger serve --port 50110 --replay testnet.rec
+
+##########
+# Logger #
+##########
+import logging
+logger = logging.getLogger(__name__)
+
+
+###########
+# Imports #
+###########
+import argparse
+import struct
+from concurrent import futures
+
+import grpc
+
+from lib.admission_control_pb2_grpc import AdmissionControlServicer, AdmissionControlStub, \
+    add_AdmissionControlServicer_to_server
+from lib.events_pb2 import EventsList
+from lib.get_with_proof_pb2 import UpdateToLatestLedgerRequest, UpdateToLatestLedgerResponse, \
+    RequestItem, GetTransactionsRequest
+from lib.transaction_info_pb2 import TransactionInfo
+from lib.transaction_pb2 import RawTransaction, SignedTransaction, TransactionListWithProof
+
+
+###########
+# Globals #
+###########
+MINT = bytes(32)
+P2P_CODE = b'LIBRAVM\n' + bytes(range(256))[:180]  # stands in for the peer_to_peer_transfer script
+START_TIME = 1561000000
+
+
+###########
+# Ledgers #
+###########
+class SyntheticLedger:
+    """Deterministic testnet-like history: every 10th transaction is a mint, the rest are
+    transfers between a pool of accounts, each with a sent and a received event."""
+    def __init__(self, versions, accounts=1000):
+        self.latest = versions
+        self.accounts = [struct.pack('>Q', i + 1) * 4 for i in range(accounts)]
+        self.transactions = {}  # built once, so serving measures the client rather than the generator
+
+    def transaction(self, version):
+        # (SignedTransaction, TransactionInfo, EventsList) of a version
+        if version not in self.transactions:
+            self.transactions[version] = self.generate(version)
+        return self.transactions[version]
+
+    def generate(self, version):
+        sender = MINT if version % 10 == 0 else self.accounts[version % len(self.accounts)]
+        receiver = self.accounts[(version * 7919) % len(self.accounts)]
+        amount = (version % 1000 + 1) * 1000000
+
+        raw = RawTransaction(sender_account=sender, sequence_number=version // len(self.accounts),
+                             max_gas_amount=10000, gas_unit_price=0, expiration_time=START_TIME + version)
+        raw.program.code = P2P_CODE
+        raw.program.arguments.add(type=1, data=receiver)
+        raw.program.arguments.add(type=0, data=struct.pack('<Q', amount))
+        tx = SignedTransaction(raw_txn_bytes=raw.SerializeToString(), sender_public_key=sender,
+                               sender_signature=struct.pack('>Q', version) * 8)
+
+        info = TransactionInfo(signed_transaction_hash=struct.pack('>Q', version) * 4,
+                               state_root_hash=struct.pack('>Q', version + 1) * 4,
+                               event_root_hash=struct.pack('>Q', version + 2) * 4, gas_used=version % 100)
+
+        events = EventsList()
+        events.events.add(access_path={'address': sender, 'path': b'\x01sent'}, sequence_number=version,
+                          event_data=struct.pack('<Q', amount) + receiver)
+        events.events.add(access_path={'address': receiver, 'path': b'\x01received'}, sequence_number=version,
+                          event_data=struct.pack('<Q', amount) + sender)
+        return tx, info, events
+
+    def account_blob(self, address):
+        # same trailing layout as the account resource parsed by get_acct_info
+        return b'\x00' * 40 + struct.pack('=32sQ?QQQ', address, 1000000000, False, 10, 10, 10)
+
+
+class RecordedLedger(SyntheticLedger):
+    """History recorded from a real server, account states are still synthetic."""
+    def __init__(self, path):
+        SyntheticLedger.__init__(self, 0)
+        with open(path, 'rb') as f:
+            while True:
+                prefix = f.read(4)
+                if not prefix:
+                    break
+                lst = TransactionListWithProof.FromString(f.read(struct.unpack('<I', prefix)[0]))
+                first = lst.first_transaction_version.value
+                events = lst.events_for_versions.events_for_version
+                for i, (tx, info) in enumerate(zip(lst.transactions, lst.infos)):
+                    self.transactions[first + i] = (tx, info, events[i] if i < len(events) else EventsList())
+        self.latest = max(self.transactions) if self.transactions else 0
+
+    def generate(self, version):
+        raise KeyError('version {} was not recorded'.format(version))
+
+
+##########
+# Server #
+##########
+class FakeAdmissionControl(AdmissionControlServicer):
+    def __init__(self, ledger):
+        self.ledger = ledger
+
+    def UpdateToLatestLedger(self, request, context):
+        resp = UpdateToLatestLedgerResponse()
+        resp.ledger_info_with_sigs.ledger_info.version = self.ledger.latest
+        for item in request.requested_items:
+            kind = item.WhichOneof('requested_items')
+            out = resp.response_items.add()
+            if kind == 'get_transactions_request':
+                req = item.get_transactions_request
+                lst = out.get_transactions_response.txn_list_with_proof
+                last = min(req.start_version + req.limit, self.ledger.latest + 1)
+                if last > req.start_version:
+                    lst.first_transaction_version.value = req.start_version
+                for version in range(req.start_version, last):
+                    tx, info, events = self.ledger.transaction(version)
+                    lst.transactions.add().CopyFrom(tx)
+                    lst.infos.add().CopyFrom(info)
+                    if req.fetch_events:
+                        lst.events_for_versions.events_for_version.add().CopyFrom(events)
+            elif kind == 'get_account_state_request':
+                state = out.get_account_state_response.account_state_with_proof
+                state.version = self.ledger.latest
+                state.blob.blob = self.ledger.account_blob(item.get_account_state_request.address)
+        return resp
+
+
+def serve(ledger, port, workers=8):
+    server = grpc.server(futures.ThreadPoolExecutor(max_workers=workers))
+    add_AdmissionControlServicer_to_server(FakeAdmissionControl(ledger), server)
+    server.add_insecure_port('127.0.0.1:{}'.format(port))
+    server.start()
+    return server
+
+
+def record(address, first, last, path, batch=500):
+    # save a range of a real ledger as length prefixed TransactionListWithProof messages
+    stub = AdmissionControlStub(grpc.insecure_channel(address))
+    with open(path, 'wb') as f:
+        version = first
+        while version <= last:
+            req = GetTransactionsRequest(start_version=version, limit=min(batch, last - version + 1), fetch_events=True)
+            resp = stub.UpdateToLatestLedger(UpdateToLatestLedgerRequest(
+                requested_items=[RequestItem(get_transactions_request=req)]))
+            lst = resp.response_items[0].get_transactions_response.txn_list_with_proof
+            if not lst.transactions:
+                break
+            data = lst.SerializeToString()
+            f.write(struct.pack('<I', len(data)))
+            f.write(data)
+            version += len(lst.transactions)
+            logger.info('recorded up to version {}'.format(version - 1))
+
+
+########
+# Main #
+########
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description='fake AdmissionControl server for benchmarks')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    cmd = commands.add_parser('serve', help='serve a synthetic or recorded ledger')
+    cmd.add_argument('--port', type=int, default=50110)
+    cmd.add_argument('--versions', type=int, default=100000, help='length of the synthetic ledger')
+    cmd.add_argument('--accounts', type=int, default=1000, help='accounts of the synthetic ledger')
+    cmd.add_argument('--replay', help='serve a recording instead')
+
+    cmd = commands.add_parser('record', help='record a range of a real ledger')
+    cmd.add_argument('path')
+    cmd.add_argument('--server', required=True, help='host:port of an AdmissionControl server')
+    cmd.add_argument('--first', type=int, default=1)
+    cmd.add_argument('--last', type=int, required=True)
+
+    args = parser.parse_args()
+    if args.command == 'record':
+        record(args.server, args.first, args.last, args.path)
+    else:
+        ledger = RecordedLedger(args.replay) if args.replay else SyntheticLedger(args.versions, args.accounts)
+        server = serve(ledger, args.port)
+        logger.info('serving {} versions on port {}'.format(ledger.latest, args.port))
+        server.wait_for_termination()
@@ -0,0 +1,110 @@
+# Cache backends for Flask-Caching
+# select with CACHE_TYPE in config.json, e.g.:
+#   "cache_backends.lru_cache"  - thread safe in-process LRU (default)
+#   "filesystem"                - shared by all processes on the host through CACHE_DIR
+#   "redis" / "memcached"       - shared through CACHE_REDIS_URL / CACHE_MEMCACHED_SERVERS
+
+##########
+# Logger #
+##########
+import logging
+logger = logging.getLogger(__name__)
+
+
+###########
+# Imports #
+###########
+import pickle
+from collections import OrderedDict
+from threading import Lock
+from time import time
+
+from flask_caching.backends.base import BaseCache
+
+
+############
+# Backends #
+############
+class LRUCache(BaseCache):
+    """Thread safe in-process cache, evicts the least recently used entry above threshold.
+
+    Values are pickled like in the other backends so a cached response is never shared
+    between request threads.
+    """
+    def __init__(self, threshold=1000, default_timeout=300):
+        BaseCache.__init__(self, default_timeout=default_timeout)
+        self.threshold = threshold
+        self.lock = Lock()
+        self.entries = OrderedDict()  # key -> (expires_at or 0, value)
+
+    def _expires_at(self, timeout):
+        # a timeout of 0 never expires
+        if timeout is None:
+            timeout = self.default_timeout
+        return time() + timeout if timeout > 0 else 0
+
+    def _live(self, key):
+        # caller holds the lock
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        if entry[0] and entry[0] <= time():
+            del self.entries[key]
+            return None
+        self.entries.move_to_end(key)
+        return entry
+
+    def _store(self, key, value, timeout):
+        # caller holds the lock
+        self.entries[key] = (self._expires_at(timeout), pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.threshold:
+            self.entries.popitem(last=False)
+
+    def get(self, key):
+        with self.lock:
+            entry = self._live(key)
+        return pickle.loads(entry[1]) if entry else None
+
+    def set(self, key, value, timeout=None):
+        with self.lock:
+            self._store(key, value, timeout)
+        return True
+
+    def add(self, key, value, timeout=None):
+        with self.lock:
+            if self._live(key):
+                return False
+            self._store(key, value, timeout)
+        return True
+
+    def delete(self, key):
+        with self.lock:
+            return self.entries.pop(key, None) is not None
+
+    def has(self, key):
+        with self.lock:
+            return self._live(key) is not None
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+        return True
+
+    def inc(self, key, delta=1):
+        with self.lock:
+            entry = self._live(key)
+            value = (pickle.loads(entry[1]) if entry else 0) + delta
+            self.entries[key] = (entry[0] if entry else self._expires_at(None), pickle.dumps(value))
+        return value
+
+    def dec(self, key, delta=1):
+        return self.inc(key, -delta)
+
+
+#############
+# Factories #
+#############
+def lru_cache(app, config, args, kwargs):
+    kwargs.update(threshold=config['CACHE_THRESHOLD'])
+    return LRUCache(*args, **kwargs)
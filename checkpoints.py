@@ -0,0 +1,111 @@
+# Committed version ranges of the transactions table and detection of the versions missing from it
+
+##########
+# Logger #
+##########
+import logging
+logger = logging.getLogger(__name__)
+
+
+###########
+# Imports #
+###########
+from datetime import datetime
+
+from sqlalchemy import func
+
+from models import IngestCheckpoint, Transaction
+
+
+#########
+# Funcs #
+#########
+def record_checkpoint(session, first, last, model=IngestCheckpoint):
+    # mark versions first to last as committed, in the transaction inserting them
+    # model is IngestCheckpoint or a class mapped to its shadow table during a testnet reset
+    # ranges stay disjoint: the range holding or ending right before first is extended, so the db worker
+    # (extending the newest range) and the gap repair (filling holes below it) never update the same row
+    prev = session.query(model).filter(model.first <= first) \
+        .filter(model.last >= first - 1).order_by(model.first.desc()).first()
+    if prev is None:
+        session.add(model(first=first, last=last, committed_at=datetime.utcnow()))
+    elif prev.last < last:
+        prev.last = last
+        prev.committed_at = datetime.utcnow()
+
+
+def version_gaps(session, low, high):
+    # [(first, last)] of the versions between low and high missing from the transactions table
+    # one ordered pass over the primary key comparing every version with the next one
+    nxt = func.lead(Transaction.version).over(order_by=Transaction.version)
+    rows = session.query(Transaction.version.label('version'), nxt.label('next')) \
+        .filter(Transaction.version >= low).filter(Transaction.version <= high).subquery()
+    gaps = [(v + 1, n - 1) for v, n in session.query(rows.c.version, rows.c.next)
+            .filter(rows.c.next > rows.c.version + 1).order_by(rows.c.version)]
+
+    first, last = session.query(func.min(Transaction.version), func.max(Transaction.version)) \
+        .filter(Transaction.version >= low).filter(Transaction.version <= high).one()
+    if first is None:
+        return [(low, high)]
+    if first > low:
+        gaps.insert(0, (low, first - 1))
+    if last < high:
+        gaps.append((last + 1, high))
+    return gaps
+
+
+def checkpoint_gaps(session, low=1):
+    # [(first, last)] of the versions from low up to the newest checkpoint that were never committed
+    nxt = func.lead(IngestCheckpoint.first).over(order_by=IngestCheckpoint.first)
+    rows = session.query(IngestCheckpoint.last.label('last'), nxt.label('next')).subquery()
+    gaps = [(max(l + 1, low), n - 1) for l, n in session.query(rows.c.last, rows.c.next)
+            .filter(rows.c.next > rows.c.last + 1).filter(rows.c.next > low).order_by(rows.c.last)]
+
+    first = session.query(func.min(IngestCheckpoint.first)).scalar()
+    if first is not None and first > low:
+        gaps.insert(0, (low, first - 1))
+    return gaps
+
+
+def merge_ranges(ranges):
+    # sorted union of overlapping or adjacent (first, last) ranges
+    merged = []
+    for first, last in sorted(ranges):
+        if merged and first <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], last))
+        else:
+            merged.append((first, last))
+    return merged
+
+
+def seed_checkpoints(session):
+    # rebuild the checkpoints from the versions present in the transactions table
+    session.query(IngestCheckpoint).delete()
+    first, last = session.query(func.min(Transaction.version), func.max(Transaction.version)).one()
+    if first is None:
+        return
+    start = first
+    for gap_first, gap_last in version_gaps(session, first, last):
+        session.add(IngestCheckpoint(first=start, last=gap_first - 1, committed_at=datetime.utcnow()))
+        start = gap_last + 1
+    session.add(IngestCheckpoint(first=start, last=last, committed_at=datetime.utcnow()))
+    session.flush()
+    logger.info('checkpoints rebuilt from the transactions table up to version {}'.format(last))
+
+
+def resume_version(session):
+    # last version of the newest committed range, the db worker continues after it
+    # tables written without checkpoints (older releases, restores) are scanned once
+    last = session.query(func.max(IngestCheckpoint.last)).scalar()
+    latest = session.query(func.max(Transaction.version)).scalar()
+    if latest is not None and (last is None or latest > last):
+        seed_checkpoints(session)
+        last = latest
+    return last
+
+
+def trim_checkpoints(session, floor):
+    # forget the committed ranges below floor after their versions were archived
+    session.query(IngestCheckpoint).filter(IngestCheckpoint.last < floor).delete(synchronize_session=False)
+    session.query(IngestCheckpoint).filter(IngestCheckpoint.first < floor) \
+        .update({IngestCheckpoint.first: floor}, synchronize_session=False)
@@ -0,0 +1,63 @@
+# Column-wise decoding helpers for batches of transactions
+# a batch is a dict of column name -> list of values, one list per table column
+# NumPy is optional and only speeds up the u64 columns
+
+###########
+# Imports #
+###########
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+###########
+# Globals #
+###########
+MAX_BIGINT = 2**63 - 1  # u64 values are clamped to fit a signed BIGINT column
+
+
+#########
+# Funcs #
+#########
+def hex_column(values):
+    # bytes.hex of every value with a single conversion of the whole column
+    if not values:
+        return []
+    joined = b''.join(values).hex()
+    width = 2 * len(values[0])
+    if all(len(v) == len(values[0]) for v in values):
+        return [joined[i:i + width] for i in range(0, len(joined), width)]
+
+    # values of different lengths
+    res = []
+    pos = 0
+    for v in values:
+        res.append(joined[pos:pos + 2 * len(v)])
+        pos += 2 * len(v)
+    return res
+
+
+def u64_column(values):
+    # little endian u64 byte strings as ints, clamped to MAX_BIGINT
+    if np is not None and values and all(len(v) == 8 for v in values):
+        return np.minimum(np.frombuffer(b''.join(values), dtype='<u8'), MAX_BIGINT).tolist()
+    return [min(int.from_bytes(v, 'little'), MAX_BIGINT) for v in values]
+
+
+def clamp_column(values):
+    # unsigned ints clamped to MAX_BIGINT
+    if np is not None and values:
+        return np.minimum(np.array(values, dtype=np.uint64), MAX_BIGINT).tolist()
+    return [v if v <= MAX_BIGINT else MAX_BIGINT for v in values]
+
+
+def column_count(columns):
+    return len(columns['version']) if columns else 0
+
+
+def column_rows(columns, names=None):
+    # one dict per row, for the consumers that work row by row
+    names = list(columns) if names is None else names
+    for values in zip(*(columns[name] for name in names)):
+        yield dict(zip(names, values))
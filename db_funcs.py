@@ -10,22 +10,398 @@ logger = logging.getLogger(__name__)
 ###########
 # Imports #
 ###########
-from sqlalchemy import create_engine, func
-from sqlalchemy.ext.serializer import dumps
-from threading import Thread
-from time import sleep, gmtime, strftime
-import gzip
+import grpc
+from sqlalchemy import create_engine, func, desc, inspect, bindparam, MetaData, Table, Index, tuple_
+from sqlalchemy.ext.declarative import declarative_base
+from threading import Thread, Lock
+from datetime import datetime
+from time import sleep, gmtime, strftime, time
+from collections import deque
+from itertools import repeat
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import multiprocessing
+import heapq
+import io
+import os
+
+import rpc_client
+from rpc_client import get_latest_version_from_ledger, get_raw_tx_lst, get_raw_tx_bytes, decode_tx_data, \
+    decode_tx_bytes, init_decoder, INGEST_RETRY_CODES
+from models import Session, Base, Transaction, Script, Event, StatsBucket, IndexerStatus, IngestCheckpoint, \
+    session_scope
+from rate_control import BatchController
+from rollups import update_rollups, rebuild_rollups, ROLLUP_COLUMNS
+from checkpoints import record_checkpoint, version_gaps, checkpoint_gaps, merge_ranges, resume_version
+from columns import column_count, column_rows
+from archive import dump_table
+from partitions import partitioning_supported, create_partitioned, is_partitioned, partition_tables, partition_floor, \
+    ensure_partitions, rename_partitions
+from acct_cache import invalidate_rows
+
+
+###########
+# Globals #
+###########
+latest_version = None          # last version committed by the db worker running in this process
+latest_version_file = ''       # optional file that shares latest_version with other processes
+latest_version_file_cache = (None, None)  # (mtime, version) of the last read of that file
+RESET_TABLES = [Transaction.__table__, Event.__table__]  # rebuilt in shadow tables when the testnet resets
+DERIVED_TABLES = [StatsBucket.__table__, IngestCheckpoint.__table__]  # kept up to date in shadows next to them
+ShadowBase = declarative_base()  # classes mapped to the shadow tables, see shadow_model
+PARTITIONED_TABLES = ['transactions']  # range partitioned by version when DB_PARTITION_SIZE is set
 
-from rpc_client import get_latest_version_from_ledger, get_raw_tx_lst, parse_raw_tx_lst
-from models import Session, Base, Transaction, session_scope
 
 #########
 # Funcs #
 #########
-def get_latest_version(session):
+def db_url(config):
+    return "{DB_DIALECT}+{DB_DRIVER}://{DB_USERNAME}:{DB_PASSWORD}@{DB_HOST}:{DB_PORT}/{DB_NAME}".format(**config)
+
+
+def use_latest_version_file(path):
+    global latest_version_file
+    latest_version_file = path
+
+
+def set_latest_version(version):
+    # called by the db worker after each committed batch
+    global latest_version
+    latest_version = version
+
+    if latest_version_file and version is not None:
+        # write and rename so readers never see a partial file
+        tmp_path = latest_version_file + '.tmp'
+        with open(tmp_path, 'w') as f:
+            f.write(str(version))
+        os.replace(tmp_path, latest_version_file)
+
+
+def read_latest_version_file():
+    global latest_version_file_cache
+    try:
+        mtime = os.stat(latest_version_file).st_mtime_ns
+    except OSError:
+        return None
+
+    if mtime != latest_version_file_cache[0]:
+        try:
+            with open(latest_version_file, 'r') as f:
+                latest_version_file_cache = (mtime, int(f.read()))
+        except (OSError, ValueError):
+            return None
+    return latest_version_file_cache[1]
+
+
+def query_latest_version(session):
     return session.query(func.max(Transaction.version)).scalar()
 
 
+def acct_changed_since(acct, version):
+    # has a transaction touching acct been ingested after version
+    latest = get_latest_version()
+    if latest is None or latest <= version:
+        return False
+
+    with session_scope() as session:
+        newer = lambda col: session.query(Transaction.version).filter(col == acct) \
+            .filter(Transaction.version > version).first() is not None
+        return newer(Transaction.src) or newer(Transaction.dest)
+
+
+def bind_session(config):
+    # engine for processes that only read, the db worker binds its own
+    engine = create_engine(db_url(config), pool_pre_ping=True)
+    Session.configure(bind=engine)
+    return engine
+
+
+def get_latest_version(session=None):
+    # served from the worker's holder or the shared file, the db is only asked when neither is available
+    if latest_version is not None:
+        return latest_version
+
+    if latest_version_file:
+        version = read_latest_version_file()
+        if version is not None:
+            return version
+
+    if session is None:
+        with session_scope() as session:
+            return query_latest_version(session)
+    return query_latest_version(session)
+
+
+def get_acct_txs(session, acct, before_version=None, limit=100):
+    # newest transactions of an account, keyset paginated by version and yielded as the cursors stream them
+    # src and dest are queried separately so each side walks its own (column, version) index
+    def side(col):
+        q = session.query(Transaction).filter(col == acct)
+        if before_version is not None:
+            q = q.filter(Transaction.version < before_version)
+        return q.order_by(desc(Transaction.version)).limit(limit).yield_per(25)
+
+    last = None
+    count = 0
+    for tx in heapq.merge(side(Transaction.src), side(Transaction.dest), key=lambda tx: -tx.version):
+        if tx.version == last:
+            continue  # transfer to self shows up on both sides
+        last = tx.version
+        yield tx
+        count += 1
+        if count == limit:
+            return
+
+
+def get_acct_events(session, acct, before=None, limit=100):
+    # newest events stored under an account's access paths, keyset paginated by (version, event_index)
+    # a transaction can emit several events for the same account, so a page may end inside a version
+    q = session.query(Event).filter(Event.address == acct)
+    if before is not None:
+        q = q.filter(tuple_(Event.version, Event.event_index) < tuple_(*before))
+    return q.order_by(desc(Event.version), desc(Event.event_index)).limit(limit).all()
+
+
+def ensure_indexes(engine, table):
+    # create_all skips existing tables, so add indexes declared after the table was created
+    existing = {tuple(ix['column_names']) for ix in inspect(engine).get_indexes(table.name)}
+    for index in table.indexes:
+        if tuple(c.name for c in index.columns) not in existing:
+            logger.info('creating index {} on {}'.format(index.name, table.name))
+            index.create(engine)
+
+
+def copy_escape(v):
+    # encode a single value for PostgreSQL COPY text format
+    if v is None:
+        return '\\N'
+    if isinstance(v, bytes):
+        return '\\\\x' + v.hex()
+    if isinstance(v, str):
+        return v.replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+    return str(v)
+
+
+def copy_columns(session, table, columns):
+    # stream a batch of columns into the table with COPY FROM STDIN inside the session's transaction
+    # columns the batch doesn't have are NULL
+    cols = table.columns.keys()
+    n = column_count(columns)
+    buf = io.StringIO()
+    for values in zip(*(map(copy_escape, columns[c]) if c in columns else repeat('\\N', n) for c in cols)):
+        buf.write('\t'.join(values))
+        buf.write('\n')
+    buf.seek(0)
+
+    quote = session.get_bind().dialect.identifier_preparer.quote
+    cursor = session.connection().connection.cursor()
+    cursor.copy_expert('COPY {} ({}) FROM STDIN'.format(quote(table.name), ', '.join(quote(c) for c in cols)), buf)
+
+
+def copy_rows(session, table, rows):
+    copy_columns(session, table, {c: [row.get(c) for row in rows] for c in table.columns.keys()})
+
+
+def insert_rows(session, model, rows, method='auto', table=None):
+    # bulk insert parsed rows, method is one of: auto, copy, executemany, orm
+    # table is a copy of model's table to write into instead (e.g. a shadow table)
+    if not rows:
+        return
+    if table is None:
+        table = model.__table__
+    if method == 'auto':
+        method = 'copy' if session.get_bind().dialect.driver == 'psycopg2' else 'executemany'
+    if method == 'orm' and table is not model.__table__:
+        method = 'executemany'  # mapped classes only know their own table
+
+    if method == 'copy':
+        copy_rows(session, table, rows)
+    elif method == 'executemany':
+        session.execute(table.insert(), rows)
+    else:
+        session.add_all(model(**v) for v in rows)
+
+
+def insert_columns(session, model, columns, method='auto', table=None):
+    # bulk insert a batch of columns (see columns.py), COPY reads them without building rows
+    if not column_count(columns):
+        return
+    if method == 'copy' or (method == 'auto' and session.get_bind().dialect.driver == 'psycopg2'):
+        copy_columns(session, model.__table__ if table is None else table, columns)
+    else:
+        insert_rows(session, model, list(column_rows(columns)), method, table)
+
+
+def insert_scripts(session, scripts, known):
+    # add the scripts of a batch that are not stored yet, known is the caller's set of stored hashes
+    new = [h for h in scripts if h not in known]
+    if not new:
+        return
+    stored = {h for h, in session.query(Script.hash).filter(Script.hash.in_(new))}
+    insert_rows(session, Script, [{'hash': h, 'code': scripts[h]} for h in new if h not in stored], 'executemany')
+    known.update(new)
+
+
+class DecoderPool:
+    """Processes decoding serialized responses, shared by the ingestion threads.
+
+    The processes are spawned so they don't inherit grpc state. When one dies (OOM, crash) the
+    executor is broken for good, so it is replaced and the batch decoded again once.
+    """
+    def __init__(self, processes):
+        self.processes = processes
+        self.lock = Lock()
+        self.pool = self.start()
+
+    def start(self):
+        return ProcessPoolExecutor(max_workers=self.processes, mp_context=multiprocessing.get_context('spawn'),
+                                   initializer=init_decoder, initargs=(rpc_client.MINT_ACCOUNT,))
+
+    def decode(self, data, light=False):
+        pool = self.pool
+        try:
+            return pool.submit(decode_tx_bytes, data, light).result()
+        except BrokenProcessPool:
+            with self.lock:
+                # only the first thread to see the broken pool replaces it
+                if self.pool is pool:
+                    logger.warning('a decoder process died, starting a new decoder pool')
+                    pool.shutdown(wait=False)
+                    self.pool = self.start()
+            return self.pool.submit(decode_tx_bytes, data, light).result()
+
+
+def fetch_tx_batch(version, limit, controller, light=False, decoder=None):
+    # fetch and decode one range of versions into (transaction columns, event columns, scripts), runs on the ingestion pool
+    # light batches come without events and program, with a decoder the protobuf parsing happens in its processes
+    while True:
+        start = time()
+        try:
+            # throttling is not retried by the client, so the controller sees every RESOURCE_EXHAUSTED
+            if decoder is not None:
+                data = get_raw_tx_bytes(version, limit, not light, INGEST_RETRY_CODES)
+            else:
+                tx_data = get_raw_tx_lst(version, limit, not light, INGEST_RETRY_CODES)
+        except grpc.RpcError as e:
+            if e.code() != grpc.StatusCode.RESOURCE_EXHAUSTED:
+                raise
+            controller.throttled()
+            sleep(controller.window()[1])
+            continue
+        controller.completed(time() - start)
+        if decoder is not None:
+            return decoder.decode(data, light)
+        return decode_tx_data(tx_data, light)
+
+
+#################
+# Testnet reset #
+#################
+# after a reset the new history is ingested into shadow tables while the old one is still served,
+# once caught up they are indexed and then renamed into place in one transaction, the old tables are backed up
+def create_shadows(engine, tables, partitioned=False):
+    # copies of the tables without secondary indexes, those are built once the shadows caught up
+    suffix = strftime('%Y%m%d%H%M%S')
+    shadows = {}
+    for table in tables:
+        name = '{}_shadow_{}'.format(table.name, suffix)
+        if partitioned and table.name in PARTITIONED_TABLES:
+            shadows[table.name] = create_partitioned(engine, table, name)
+            continue
+        shadows[table.name] = Table(name, MetaData(), *[c.copy() for c in table.columns])
+        shadows[table.name].create(engine)
+        logger.info('created shadow table {}'.format(shadows[table.name].name))
+    return shadows
+
+
+def shadow_model(table):
+    # a class mapped to a shadow table, for the helpers written against the models
+    return type(str(table.name), (ShadowBase,), {'__table__': table})
+
+
+def shadow_index_name(index, shadow):
+    # ix_transactions_src_version -> ix_transactions_src_version_shadow_<suffix>
+    return index.name + shadow.name[len(index.table.name):]
+
+
+def index_shadows(engine, shadows):
+    # build the secondary indexes of the shadows under their own names, the swap only renames them
+    for table in RESET_TABLES:
+        shadow = shadows[table.name]
+        for index in table.indexes:
+            name = shadow_index_name(index, shadow)
+            logger.info('creating index {} on {}'.format(name, shadow.name))
+            Index(name, *[shadow.c[c.name] for c in index.columns]).create(engine)
+
+
+def drop_tables(engine, names):
+    quote = engine.dialect.identifier_preparer.quote
+    with engine.begin() as conn:
+        for name in names:
+            conn.execute('DROP TABLE IF EXISTS {}'.format(quote(name)))
+
+
+def swap_shadows(engine, shadows):
+    # atomically replace the live tables with their indexed shadows, returns the names of the old tables
+    # only drops and renames: the tables are locked for readers until the transaction ends
+    quote = engine.dialect.identifier_preparer.quote
+    suffix = strftime('%Y%m%d%H%M%S')
+    old_names = []
+    with engine.begin() as conn:
+        for table in RESET_TABLES:
+            old_name = '{}_old_{}'.format(table.name, suffix)
+            # index names are unique per schema, free them for the new table
+            for index in inspect(conn).get_indexes(table.name):
+                conn.execute('DROP INDEX {}'.format(quote(index['name'])))
+            conn.execute('ALTER TABLE {} RENAME TO {}'.format(quote(table.name), quote(old_name)))
+            conn.execute('ALTER TABLE {} RENAME TO {}'.format(quote(shadows[table.name].name), quote(table.name)))
+            rename_partitions(conn, old_name, table.name, old_name)
+            rename_partitions(conn, table.name, shadows[table.name].name, table.name)
+            for index in table.indexes:
+                name = shadow_index_name(index, shadows[table.name])
+                if conn.dialect.name == 'postgresql':
+                    conn.execute('ALTER INDEX {} RENAME TO {}'.format(quote(name), quote(index.name)))
+                else:
+                    # sqlite can't rename an index
+                    conn.execute('DROP INDEX {}'.format(quote(name)))
+                    index.create(conn)
+            old_names.append(old_name)
+
+        # the rollups and checkpoints of the old history are not kept
+        for table in DERIVED_TABLES:
+            conn.execute('DROP TABLE {}'.format(quote(table.name)))
+            conn.execute('ALTER TABLE {} RENAME TO {}'.format(quote(shadows[table.name].name), quote(table.name)))
+    logger.info('swapped in shadow tables, old tables: {}'.format(', '.join(old_names)))
+    return old_names
+
+
+def backup_tables(engine, names, backup_path):
+    # backup then drop the tables replaced by a swap, runs next to ingestion
+    # restore with: python3 backup.py restore <file>
+    for name in names:
+        file_path = '{}_{}.lba'.format(backup_path, name)
+        try:
+            logger.info('saving {} to {}'.format(name, file_path))
+            dump_table(engine, name, file_path)
+            drop_tables(engine, [name])
+            logger.info('saved and dropped {}'.format(name))
+        except:
+            logger.exception('backup of {} failed, the table is kept'.format(name))
+
+
+def recover_reset(engine, backup_path):
+    # a restart during a reset: the shadow tables are rebuilt from scratch and pending backups resumed
+    with engine.connect() as conn:
+        names = set(inspect(conn).get_table_names()) - partition_tables(conn)
+    stale = [n for n in names for t in RESET_TABLES + DERIVED_TABLES if n.startswith(t.name + '_shadow_')]
+    if stale:
+        logger.info('dropping unfinished shadow tables: {}'.format(', '.join(stale)))
+        drop_tables(engine, stale)
+    old = [n for n in names for t in RESET_TABLES if n.startswith(t.name + '_old_')]
+    if old:
+        Thread(target=backup_tables, args=(engine, old, backup_path), daemon=True).start()
+
+
 #############
 # DB Worker #
 #############
@@ -33,25 +409,99 @@ def get_latest_version(session):
 class TxDBWorker(Thread):
     def __init__(self, config):
         Thread.__init__(self)
-        self.url = "{DB_DIALECT}+{DB_DRIVER}://{DB_USERNAME}:{DB_PASSWORD}@{DB_HOST}:{DB_PORT}/{DB_NAME}".format(**config)
+        self.url = db_url(config)
         logger.info('sqlalchemy.url: {}'.format(self.url))
         self.db_backup_path = config['DB_BACKUP_PATH']
+        self.pool_size = config['INGEST_POOL_SIZE']      # concurrent fetch + parse tasks
+        self.queue_depth = config['INGEST_QUEUE_DEPTH']  # batches in flight ahead of the writer
+        self.insert_method = config['DB_INSERT_METHOD']
+        self.controller = BatchController(config)
+        if config['LATEST_VERSION_FILE']:
+            use_latest_version_file(config['LATEST_VERSION_FILE'])
         self.running = False
+        self.versions_per_sec = 0.0
+        self.shadows = None  # table name -> shadow table while ingesting after a testnet reset
+        self.shadow_models = None  # table name -> class mapped to the shadow of a derived table
+        self.swaps = 0  # number of shadow swaps, the history before one is gone
+        self.light = config['INGEST_LIGHT']  # core columns only, the rest is filled in by a BackfillWorker
+        self.backfill = None
+        self.known_scripts = set()  # hashes already in the scripts table
+        self.decode_processes = config['INGEST_DECODE_PROCESSES']  # 0 decodes on the ingestion pool threads
+        self.decoder = None
+        self.gap_scan_interval = config['GAP_SCAN_INTERVAL']  # seconds between gap scans, 0 disables the repair
+        self.gap_scan_window = config['GAP_SCAN_WINDOW']      # versions of the table scanned each time
+        self.gap_repair = None
+        self.partition_size = config['DB_PARTITION_SIZE']  # versions per partition of the transactions table, 0 disables
+        self.partitions = {}  # table name -> versions known to have partitions, see ensure_partitions
+
+    def record_progress(self, session, version):
+        # progress of the worker for other processes, in the same transaction as the batch
+        batch, delay = self.controller.window()
+        session.merge(IndexerStatus(id=1, version=version, versions_per_sec=self.versions_per_sec,
+                                    batch=batch, delay=delay, updated_at=datetime.utcnow()))
+
+    def setup_partitions(self, engine):
+        # a new transactions table is created partitioned, an existing one is from the next testnet reset on
+        with engine.begin() as conn:
+            if not partitioning_supported(conn):
+                logger.warning('DB_PARTITION_SIZE needs PostgreSQL 11 or later, transactions stay in one table')
+                self.partition_size = 0
+                return
+            for name in PARTITIONED_TABLES:
+                if not engine.dialect.has_table(conn, name):
+                    create_partitioned(conn, Base.metadata.tables[name])
+                elif not is_partitioned(conn, name):
+                    logger.info('{} was created without partitions, they are used after the next reset'.format(name))
+
+    def ensure_partitions(self, session, name, first, last):
+        # partitions for a batch about to be inserted, in its transaction
+        if self.partition_size and name.split('_shadow_')[0] in PARTITIONED_TABLES:
+            ensure_partitions(session.connection(), name, self.partition_size, first, last, self.partitions)
+
+    def update_throughput(self, num, elapsed):
+        # exponential moving average of committed versions per second
+        if elapsed > 0:
+            self.versions_per_sec = 0.8 * self.versions_per_sec + 0.2 * (num / elapsed)
 
     def run(self):
         while True:
             logger.info('transactions db worker starting')
             engine = create_engine(self.url)
             Session.configure(bind=engine)
+            self.partitions = {}
+            if self.partition_size:
+                self.setup_partitions(engine)
             Base.metadata.create_all(engine)
+            for table in RESET_TABLES:
+                ensure_indexes(engine, table)
+            recover_reset(engine, self.db_backup_path)
+            self.shadows = self.shadow_models = None
+            self.known_scripts = set()
+            if self.decode_processes and self.decoder is None:
+                self.decoder = DecoderPool(self.decode_processes)
+            if self.light and self.backfill is None:
+                self.backfill = BackfillWorker(self)
+                self.backfill.start()
+            if self.gap_scan_interval and self.gap_repair is None:
+                self.gap_repair = GapRepairWorker(self)
+                self.gap_repair.start()
 
-            # get latest version in the db
+            # resume after the newest committed range
             with session_scope() as session:
-                cur_ver = session.query(func.max(Transaction.version)).scalar()
+                rebuild_rollups(session)
+                cur_ver = resume_version(session)
+            set_latest_version(cur_ver)
             cur_ver = (cur_ver + 1) if cur_ver else 1  # TODO: later handle genesis
-            
+
+            # batches are fetched and parsed concurrently but committed in order by this thread
+            pool = ThreadPoolExecutor(max_workers=self.pool_size)
+            pending = deque()   # (start version, num, future) in version order
+            next_ver = cur_ver  # first version not yet scheduled
+            last_commit = time()
+
             try:
-                logger.info('starting update at version {}'.format(cur_ver))
+                logger.info('starting update at version {} (pool: {}, queue depth: {})'.format(
+                    cur_ver, self.pool_size, self.queue_depth))
                 # start the main loop
                 while True:
                     try:
@@ -61,41 +511,236 @@ class TxDBWorker(Thread):
                         continue
                     if cur_ver > bver + 50:
                         # +50 for safety due to chance we're not in sync with latest blockchain ver
-                        file_path = '{}_{}.gz'.format(self.db_backup_path, strftime('%Y%m%d%H%M%S'))
-                        logger.info('saving database to {}'.format(file_path))
-                        with gzip.open(file_path, 'wb') as f, session_scope() as session:
-                            f.write(dumps(session.query(Transaction)))
-                        Base.metadata.drop_all(engine)
-                        Base.metadata.create_all(engine)
-                        break
-                    elif cur_ver > bver:
-                        sleep(1)
+                        # the old history stays online until the new one has caught up
+                        logger.info('ledger was reset to version {}, ingesting into shadow tables'.format(bver))
+                        self.drain(pending)
+                        if self.shadows:
+                            drop_tables(engine, [t.name for t in self.shadows.values()])
+                        self.shadows = create_shadows(engine, RESET_TABLES + DERIVED_TABLES, bool(self.partition_size))
+                        self.shadow_models = {t.name: shadow_model(self.shadows[t.name]) for t in DERIVED_TABLES}
+                        cur_ver = next_ver = 1
                         continue
 
-                    # batch update
-                    num = min(1000, bver - cur_ver)  # at most 5000 records at once
-                    tx_data = get_raw_tx_lst(cur_ver, num)
+                    # schedule batch fetches up to the queue depth
+                    while len(pending) < self.queue_depth and next_ver < bver:
+                        batch, delay = self.controller.window()
+                        num = min(batch, bver - next_ver)
+                        pending.append((next_ver, num, pool.submit(fetch_tx_batch, next_ver, num, self.controller, self.light, self.decoder)))
+                        next_ver += num
 
-                    # read records
-                    res = parse_raw_tx_lst(*tx_data)
-                    if not res:
+                        # pace requests so we don't get a 429 error
+                        sleep(delay)
+
+                    if not pending:
+                        # caught up with the ledger
+                        if self.shadows:
+                            index_shadows(engine, self.shadows)
+                            old_names = swap_shadows(engine, self.shadows)
+                            self.shadows = self.shadow_models = None
+                            self.swaps += 1
+                            self.partitions = {}
+                            with session_scope() as session:
+                                set_latest_version(query_latest_version(session))
+                            Thread(target=backup_tables, args=(engine, old_names, self.db_backup_path),
+                                   daemon=True).start()
+                        self.running = True
+                        sleep(1)
+                        continue
+
+                    # read records of the oldest batch
+                    start_ver, num, fut = pending.popleft()
+                    txs, events, scripts = fut.result()
+                    if not column_count(txs) or txs['version'][0] != cur_ver:
+                        # nothing usable, drop the speculative fetches and retry from cur_ver
+                        self.drain(pending)
+                        next_ver = cur_ver
                         sleep(5)
                         continue
 
                     # do the insertion
                     with session_scope() as session:
-                        session.add_all(Transaction(**v) for v in res)
+                        insert_scripts(session, scripts, self.known_scripts)
+                        tx_table = self.shadows['transactions'] if self.shadows else Transaction.__table__
+                        self.ensure_partitions(session, tx_table.name, txs['version'][0], txs['version'][-1])
+                        if self.shadows:
+                            # the new history gets its own rollups and checkpoints, swapped in with it
+                            insert_columns(session, Transaction, txs, self.insert_method, self.shadows['transactions'])
+                            insert_columns(session, Event, events, self.insert_method, self.shadows['events'])
+                            update_rollups(session, column_rows(txs, ROLLUP_COLUMNS), self.shadow_models['stats_buckets'])
+                            record_checkpoint(session, txs['version'][0], txs['version'][-1],
+                                              self.shadow_models['ingest_checkpoints'])
+                        else:
+                            insert_columns(session, Transaction, txs, self.insert_method)
+                            insert_columns(session, Event, events, self.insert_method)
+                            update_rollups(session, column_rows(txs, ROLLUP_COLUMNS))
+                            record_checkpoint(session, txs['version'][0], txs['version'][-1])
+                        self.record_progress(session, txs['version'][-1])
                     # update counter to the latest version we inserted
-                    cur_ver = res[-1]['version']
+                    cur_ver = txs['version'][-1]
+                    if not self.shadows:
+                        set_latest_version(cur_ver)
+                        invalidate_rows(column_rows(txs, ('version', 'src', 'dest')))
                     logger.debug('update to version: {} - success'.format(cur_ver))
 
                     # update latest version to next
                     cur_ver = cur_ver + 1
+                    if cur_ver != start_ver + num:
+                        # short batch, the ranges already in flight no longer line up
+                        self.drain(pending)
+                        next_ver = cur_ver
 
-                    # sleep relative to amount of rows fetched so we don't get a 429 error
-                    sleep(0.001 * num)
+                    now = time()
+                    self.update_throughput(column_count(txs), now - last_commit)
+                    last_commit = now
+                    logger.debug('ingestion throughput: {:.1f} versions/sec, window: batch {} delay {:.3f}s'.format(
+                        self.versions_per_sec, *self.controller.window()))
                     self.running = True
 
             except:
                 logger.exception('Major error in tx_db_worker')
                 sleep(2)
+            finally:
+                self.drain(pending)
+                pool.shutdown(wait=True)
+
+    @staticmethod
+    def drain(pending):
+        # cancel (or wait out) batches that will not be committed
+        while pending:
+            pending.popleft()[2].cancel()
+
+
+class BackfillWorker(Thread):
+    """Fills in the events and the script_hash / program_args columns skipped by light ingestion.
+
+    Walks the committed versions from the oldest light row upwards, behind the TxDBWorker
+    and sharing its rate controller, and pauses while a testnet reset is ingested.
+    """
+    def __init__(self, worker):
+        Thread.__init__(self, daemon=True)
+        self.worker = worker
+        self.update = Transaction.__table__.update() \
+            .where(Transaction.__table__.c.version == bindparam('b_version')) \
+            .values(script_hash=bindparam('script_hash'), program_args=bindparam('program_args'))
+
+    def run(self):
+        logger.info('backfill worker starting')
+        cursor = None  # first version that may still be light
+        swaps = self.worker.swaps
+        known_scripts = set()
+        while True:
+            try:
+                latest = get_latest_version()
+                if self.worker.shadows or not latest:
+                    sleep(5)
+                    continue
+                if swaps != self.worker.swaps:
+                    swaps = self.worker.swaps
+                    cursor = None
+                if cursor is None:
+                    # the unindexed scan only runs at start, after an error and when a reset replaced the history
+                    with session_scope() as session:
+                        cursor = session.query(func.min(Transaction.version)) \
+                            .filter(Transaction.script_hash == None).scalar()
+                    if cursor is None:
+                        cursor = latest + 1
+                if cursor > latest:
+                    # caught up, rows committed from now on start at the cursor
+                    sleep(1)
+                    continue
+
+                batch, delay = self.worker.controller.window()
+                txs, events, scripts = fetch_tx_batch(cursor, min(batch, latest - cursor + 1), self.worker.controller,
+                                                      decoder=self.worker.decoder)
+                if not column_count(txs) or txs['version'][0] != cursor:
+                    sleep(5)
+                    continue
+
+                last = txs['version'][-1]
+                with session_scope() as session:
+                    insert_scripts(session, scripts, known_scripts)
+                    session.execute(self.update, [
+                        {'b_version': v, 'script_hash': h, 'program_args': a}
+                        for v, h, a in zip(txs['version'], txs['script_hash'], txs['program_args'])
+                    ])
+                    # rows ingested in full already have their events
+                    session.query(Event).filter(Event.version >= cursor).filter(Event.version <= last) \
+                        .delete(synchronize_session=False)
+                    insert_columns(session, Event, events, self.worker.insert_method)
+                logger.debug('backfilled versions {} to {}'.format(cursor, last))
+                cursor = last + 1
+                sleep(delay)
+            except:
+                logger.exception('error in backfill worker')
+                cursor = None
+                known_scripts = set()
+                sleep(5)
+
+
+class GapRepairWorker(Thread):
+    """Finds versions missing below the committed head and ingests just those ranges.
+
+    Each pass looks for holes between the checkpoint ranges and scans the next window of the
+    transactions table for missing versions, wrapping around once it reaches the head, so a
+    whole table is verified every (versions / GAP_SCAN_WINDOW) passes.
+    """
+    def __init__(self, worker):
+        Thread.__init__(self, daemon=True)
+        self.worker = worker
+        self.cursor = 1  # first version of the next window to scan
+        self.known_scripts = set()
+
+    def run(self):
+        logger.info('gap repair worker starting')
+        while True:
+            try:
+                latest = get_latest_version()
+                if self.worker.shadows or not latest:
+                    sleep(5)
+                    continue
+                with session_scope() as session:
+                    # versions below the oldest partition were archived
+                    floor = max(partition_floor(session.connection(), 'transactions') or 1, 1)
+                    if self.cursor > latest or self.cursor < floor:
+                        self.cursor = floor
+                    high = min(self.cursor + self.worker.gap_scan_window - 1, latest)
+                    gaps = merge_ranges(checkpoint_gaps(session, floor) + version_gaps(session, self.cursor, high))
+                logger.debug('gap scan of versions {} to {}: {} gaps'.format(self.cursor, high, len(gaps)))
+                self.cursor = high + 1
+
+                for first, last in gaps:
+                    if self.worker.shadows:
+                        break
+                    logger.info('repairing missing versions {} to {}'.format(first, last))
+                    self.repair(first, last)
+                sleep(self.worker.gap_scan_interval)
+            except:
+                logger.exception('error in gap repair worker')
+                self.known_scripts = set()
+                sleep(5)
+
+    def repair(self, first, last):
+        # fetch and commit the versions first to last, sharing the rate controller of the db worker
+        cursor = first
+        while cursor <= last:
+            batch, delay = self.worker.controller.window()
+            txs, events, scripts = fetch_tx_batch(cursor, min(batch, last - cursor + 1), self.worker.controller,
+                                                  decoder=self.worker.decoder)
+            if not column_count(txs) or txs['version'][0] != cursor:
+                logger.warning('ledger returned no versions from {}, repair retried on the next scan'.format(cursor))
+                return
+
+            end = txs['version'][-1]
+            with session_scope() as session:
+                insert_scripts(session, scripts, self.known_scripts)
+                self.worker.ensure_partitions(session, 'transactions', cursor, end)
+                insert_columns(session, Transaction, txs, self.worker.insert_method)
+                # events may have outlived their transactions
+                session.query(Event).filter(Event.version >= cursor).filter(Event.version <= end) \
+                    .delete(synchronize_session=False)
+                insert_columns(session, Event, events, self.worker.insert_method)
+                update_rollups(session, column_rows(txs, ROLLUP_COLUMNS))
+                record_checkpoint(session, cursor, end)
+            invalidate_rows(column_rows(txs, ('version', 'src', 'dest')))
+            cursor = end + 1
+            sleep(delay)
@@ -0,0 +1,47 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Ingestion daemon: pulls transactions from the ledger into the DB, independent of the web tier
+# execute with: nohup python3 -m indexer &> indexer.log < /dev/null &
+
+################
+# Logging init #
+################
+import json
+from logging.config import dictConfig
+
+with open('logging.json', 'r') as f:
+    dictConfig( json.load(f) )
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+###########
+# Imports #
+###########
+import argparse
+
+from db_funcs import TxDBWorker
+from rpc_client import wait_for_rpc_client_instance
+from settings import load_config
+
+
+#########
+# Funcs #
+#########
+def run_ingestion(config):
+    # progress is written to indexer_status and the latest version file for the web processes
+    wait_for_rpc_client_instance(config)
+    txdb = TxDBWorker(config)
+    txdb.start()
+    txdb.join()
+
+
+########
+# Main #
+########
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='ingest LibraBrowser transactions into the DB')
+    parser.parse_args()
+
+    run_ingestion(load_config())
@@ -0,0 +1,185 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Schema migrations for existing databases
+# execute with: python3 migrate.py
+
+################
+# Logging init #
+################
+import json
+from logging.config import dictConfig
+
+with open('logging.json', 'r') as f:
+    dictConfig( json.load(f) )
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+###########
+# Imports #
+###########
+import argparse
+
+from google.protobuf import text_format
+from sqlalchemy import create_engine, inspect, text, LargeBinary
+
+from db_funcs import db_url
+from lib.transaction_pb2 import Program
+from models import Script, Transaction, StatsBucket, Session
+from rollups import ALL_TIME, HOURS, sketch_load, sketch_merge, sketch_dump
+from scripts import split_program
+from settings import load_config
+
+
+###########
+# Globals #
+###########
+# u64 amounts that used to be stored as little endian packed LargeBinary
+NUMERIC_COLUMNS = ('amount', 'gas_price', 'max_gas', 'gas_used')
+
+
+##############
+# Migrations #
+##############
+def binary_to_bigint(engine, batch):
+    # convert the packed u64 columns to BIGINT, backfilling a shadow column in batches
+    insp = inspect(engine)
+    col_types = {c['name']: c['type'] for c in insp.get_columns('transactions')}
+
+    for col in NUMERIC_COLUMNS:
+        new_col = col + '_num'
+        if not isinstance(col_types.get(col), LargeBinary) and new_col not in col_types:
+            logger.info('{} is already numeric'.format(col))
+            continue
+
+        if new_col not in col_types:
+            logger.info('adding column {}'.format(new_col))
+            with engine.begin() as conn:
+                conn.execute(text('ALTER TABLE transactions ADD COLUMN {} BIGINT'.format(new_col)))
+
+        # resumable: only rows that were not converted yet are selected, paging by key after the last batch
+        select = text('SELECT version, {0} FROM transactions WHERE version > :last AND {1} IS NULL AND {0} IS NOT NULL '
+                      'ORDER BY version LIMIT :batch'.format(col, new_col))
+        update = text('UPDATE transactions SET {} = :value WHERE version = :version'.format(new_col))
+        last = -1
+        while True:
+            with engine.begin() as conn:
+                rows = conn.execute(select, last=last, batch=batch).fetchall()
+                if not rows:
+                    break
+                conn.execute(update, [
+                    {'version': version, 'value': min(int.from_bytes(bytes(value), 'little'), 2**63 - 1)}
+                    for version, value in rows
+                ])
+            last = rows[-1][0]
+            logger.info('{} converted up to version {}'.format(col, last))
+
+        with engine.begin() as conn:
+            conn.execute(text('ALTER TABLE transactions DROP COLUMN {}'.format(col)))
+            conn.execute(text('ALTER TABLE transactions RENAME COLUMN {} TO {}'.format(new_col, col)))
+        logger.info('{} is now BIGINT'.format(col))
+
+
+def program_to_scripts(engine, batch):
+    # replace the code_hex and program text of every row by a reference into the scripts table
+    col_types = {c['name']: c['type'] for c in inspect(engine).get_columns('transactions')}
+    if 'program' not in col_types:
+        logger.info('programs are already stored as scripts')
+        return
+
+    Script.__table__.create(engine, checkfirst=True)
+    for col in ('script_hash', 'program_args'):
+        if col not in col_types:
+            logger.info('adding column {}'.format(col))
+            col_type = Transaction.__table__.c[col].type.compile(dialect=engine.dialect)
+            with engine.begin() as conn:
+                conn.execute(text('ALTER TABLE transactions ADD COLUMN {} {}'.format(col, col_type)))
+
+    # resumable: only rows that were not converted yet are selected, paging by key after the last batch
+    select = text('SELECT version, program FROM transactions WHERE version > :last AND script_hash IS NULL '
+                  'AND program IS NOT NULL ORDER BY version LIMIT :batch')
+    update = text('UPDATE transactions SET script_hash = :hash, program_args = :args WHERE version = :version')
+    known = set()
+    last = -1
+    while True:
+        with engine.begin() as conn:
+            rows = conn.execute(select, last=last, batch=batch).fetchall()
+            if not rows:
+                break
+            params = []
+            for version, program in rows:
+                hash, code, args = split_program(text_format.Parse(program, Program()))
+                if hash not in known and conn.execute(Script.__table__.select().where(Script.hash == hash)).first() is None:
+                    conn.execute(Script.__table__.insert(), hash=hash, code=code)
+                known.add(hash)
+                params.append({'version': version, 'hash': hash, 'args': args})
+            conn.execute(update, params)
+        last = rows[-1][0]
+        logger.info('programs converted up to version {}'.format(last))
+
+    with engine.begin() as conn:
+        conn.execute(text('ALTER TABLE transactions DROP COLUMN code_hex'))
+        conn.execute(text('ALTER TABLE transactions DROP COLUMN program'))
+    logger.info('{} scripts, code_hex and program columns dropped'.format(len(known)))
+
+
+def hour_rollups(engine, batch):
+    # add the hourly stats buckets to rollups built from minute buckets only, merging the minutes of every hour
+    if 'stats_buckets' not in inspect(engine).get_table_names():
+        logger.info('no stats rollups yet')
+        return
+    session = Session(bind=engine)
+    # resumable: hours are written in order, the newest one may be partial and is merged again
+    newest = session.query(StatsBucket).filter(StatsBucket.minute < ALL_TIME).order_by(StatsBucket.minute.desc()).first()
+    last = -1
+    if newest is not None:
+        last = (newest.minute - HOURS) * 60 - 1
+        session.delete(newest)
+        session.commit()
+
+    hour = None
+    while True:
+        buckets = session.query(StatsBucket).filter(StatsBucket.minute > last).order_by(StatsBucket.minute) \
+            .limit(batch).all()
+        for b in buckets:
+            if hour is None or b.minute // 60 != hour.minute - HOURS:
+                hour = session.merge(StatsBucket(minute=HOURS + b.minute // 60, first_version=b.first_version,
+                                                 mint_count=0, mint_sum=0, p2p_count=0, p2p_sum=0,
+                                                 other_count=0, other_sum=0))
+            if b.first_version is not None and (hour.first_version is None or b.first_version < hour.first_version):
+                hour.first_version = b.first_version
+            for kind in ('mint', 'p2p', 'other'):
+                setattr(hour, kind + '_count', getattr(hour, kind + '_count') + getattr(b, kind + '_count'))
+                setattr(hour, kind + '_sum', getattr(hour, kind + '_sum') + getattr(b, kind + '_sum'))
+            for col in ('src_sketch', 'dest_sketch'):
+                registers = sketch_load(getattr(hour, col))
+                sketch_merge(registers, sketch_load(getattr(b, col)))
+                setattr(hour, col, sketch_dump(registers))
+        session.commit()
+        if not buckets:
+            break
+        last = buckets[-1].minute
+        logger.info('hourly stats buckets merged up to minute {}'.format(last))
+    session.close()
+
+
+MIGRATIONS = [
+    ('binary_to_bigint', binary_to_bigint),
+    ('program_to_scripts', program_to_scripts),
+    ('hour_rollups', hour_rollups),
+]
+
+
+########
+# Main #
+########
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='migrate an existing LibraBrowser database')
+    parser.add_argument('--batch', type=int, default=10000, help='rows converted per transaction')
+    args = parser.parse_args()
+
+    engine = create_engine(db_url(load_config()))
+    for name, migration in MIGRATIONS:
+        logger.info('running migration {}'.format(name))
+        migration(engine, args.batch)
@@ -1,6 +1,6 @@
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy import Column, Integer, BigInteger, LargeBinary, String
+from sqlalchemy import Column, Integer, BigInteger, LargeBinary, String, Index, Float, DateTime
 from contextlib import contextmanager
 
 Session = sessionmaker()
@@ -23,25 +23,101 @@ def session_scope():
 
 class Transaction(Base):
     __tablename__ = 'transactions'
+    __table_args__ = (
+        # account history is read newest first per side of the transfer
+        Index('ix_transactions_src_version', 'src', 'version'),
+        Index('ix_transactions_dest_version', 'dest', 'version'),
+    )
 
     version = Column(Integer, primary_key=True)
     expiration_date = Column(String)
     src = Column(String)
     dest = Column(String)
     type = Column(String)
-    amount = Column(LargeBinary)
-    gas_price = Column(LargeBinary)
-    max_gas = Column(LargeBinary)
+    amount = Column(BigInteger)      # micro libra
+    gas_price = Column(BigInteger)
+    max_gas = Column(BigInteger)
     sq_num = Column(Integer)
     pub_key = Column(String)
     expiration_unixtime = Column(BigInteger)
-    gas_used = Column(LargeBinary)
+    gas_used = Column(BigInteger)
     sender_sig = Column(String)
     signed_tx_hash = Column(String)
     state_root_hash = Column(String)
     event_root_hash = Column(String)
-    code_hex = Column(String)
-    program = Column(String)
+    script_hash = Column(String)         # sha256 of the program code, see Script
+    program_args = Column(LargeBinary)   # Program with the arguments and modules only
 
     def __repr__(self):
         return '<Transaction(version = {0.version})>'.format(self)
+
+
+class Script(Base):
+    __tablename__ = 'scripts'
+
+    hash = Column(String, primary_key=True)
+    code = Column(LargeBinary)
+
+    def __repr__(self):
+        return '<Script(hash = {0.hash})>'.format(self)
+
+
+class Event(Base):
+    __tablename__ = 'events'
+    __table_args__ = (
+        # event history of an account, newest first
+        Index('ix_events_address_version', 'address', 'version'),
+    )
+
+    version = Column(Integer, primary_key=True)
+    event_index = Column(Integer, primary_key=True)  # position in the transaction's events
+    address = Column(String)
+    path = Column(String)
+    sequence_number = Column(BigInteger)
+    data = Column(String)
+
+    def __repr__(self):
+        return '<Event(version = {0.version}, event_index = {0.event_index})>'.format(self)
+
+
+class StatsBucket(Base):
+    __tablename__ = 'stats_buckets'
+
+    minute = Column(BigInteger, primary_key=True)  # expiration_unixtime // 60, -1 for all time, see rollups.HOURS
+    first_version = Column(Integer)
+    mint_count = Column(BigInteger)
+    mint_sum = Column(BigInteger)     # micro libra
+    p2p_count = Column(BigInteger)
+    p2p_sum = Column(BigInteger)
+    other_count = Column(BigInteger)
+    other_sum = Column(BigInteger)
+    src_sketch = Column(LargeBinary)  # zlib compressed HyperLogLog registers
+    dest_sketch = Column(LargeBinary)
+
+    def __repr__(self):
+        return '<StatsBucket(minute = {0.minute})>'.format(self)
+
+
+class IndexerStatus(Base):
+    __tablename__ = 'indexer_status'
+
+    id = Column(Integer, primary_key=True)  # single row, written by the db worker with every batch
+    version = Column(Integer)
+    versions_per_sec = Column(Float)
+    batch = Column(Integer)
+    delay = Column(Float)
+    updated_at = Column(DateTime)
+
+    def __repr__(self):
+        return '<IndexerStatus(version = {0.version})>'.format(self)
+
+
+class IngestCheckpoint(Base):
+    __tablename__ = 'ingest_checkpoints'
+
+    first = Column(Integer, primary_key=True)  # committed range of versions, first to last inclusive
+    last = Column(Integer)
+    committed_at = Column(DateTime)
+
+    def __repr__(self):
+        return '<IngestCheckpoint(first = {0.first}, last = {0.last})>'.format(self)
@@ -0,0 +1,135 @@
+# Optional range partitioning of the transactions table by version, PostgreSQL only
+# partitions are named <table>_v<first version> and created by the db worker as the ledger grows
+
+##########
+# Logger #
+##########
+import logging
+logger = logging.getLogger(__name__)
+
+
+###########
+# Imports #
+###########
+import re
+
+from sqlalchemy import MetaData, Table, text
+
+from archive import dump_table
+
+
+###########
+# Globals #
+###########
+BOUNDS = re.compile(r"FROM \('?(-?\d+)'?\) TO \('?(-?\d+)'?\)")  # of pg_get_expr(relpartbound)
+PARTITIONS_QUERY = text("SELECT c.relname, pg_get_expr(c.relpartbound, c.oid) FROM pg_inherits i "
+                        "JOIN pg_class c ON c.oid = i.inhrelid JOIN pg_class p ON p.oid = i.inhparent "
+                        "WHERE p.relname = :name")
+
+
+#########
+# Funcs #
+#########
+def partitioning_supported(conn):
+    # partitioned tables with a primary key need PostgreSQL 11
+    return conn.dialect.name == 'postgresql' and conn.dialect.server_version_info >= (11,)
+
+
+def create_partitioned(conn, table, name=None):
+    # the table, or a copy of it named name, partitioned by ranges of version and without partitions yet
+    partitioned = Table(name or table.name, MetaData(), *[c.copy() for c in table.columns],
+                        postgresql_partition_by='RANGE (version)')
+    partitioned.create(conn)
+    logger.info('created {} partitioned by version'.format(partitioned.name))
+    return partitioned
+
+
+def is_partitioned(conn, name):
+    if conn.dialect.name != 'postgresql':
+        return False
+    return conn.execute(text("SELECT 1 FROM pg_partitioned_table t JOIN pg_class c ON c.oid = t.partrelid "
+                             "WHERE c.relname = :name"), name=name).first() is not None
+
+
+def list_partitions(conn, name):
+    # [(partition, first version, end version)] of a table sorted by version, the end is exclusive
+    if conn.dialect.name != 'postgresql':
+        return []
+    res = []
+    for partition, bound in conn.execute(PARTITIONS_QUERY, name=name):
+        m = BOUNDS.search(bound or '')
+        if m:
+            res.append((partition, int(m.group(1)), int(m.group(2))))
+    return sorted(res, key=lambda p: p[1])
+
+
+def partition_tables(conn):
+    # names of all partitions, they are handled through their parent table
+    if conn.dialect.name != 'postgresql':
+        return set()
+    return {name for name, in conn.execute("SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid")}
+
+
+def partition_floor(conn, name):
+    # first version of the oldest partition still attached, None for a table without partitions
+    partitions = list_partitions(conn, name)
+    return partitions[0][1] if partitions else None
+
+
+def ensure_partitions(conn, name, size, first, last, covered):
+    # create the missing partitions of size versions for versions first to last
+    # covered caches table name -> (first, end) of versions known to have partitions, None if not partitioned
+    if name not in covered:
+        covered[name] = (0, 0) if is_partitioned(conn, name) else None
+    if covered[name] is None or (covered[name][0] <= first and last < covered[name][1]):
+        return
+
+    quote = conn.dialect.identifier_preparer.quote
+    existing = list_partitions(conn, name)
+    start = first // size * size
+    end = (last // size + 1) * size
+    lo = start
+    while lo < end:
+        hi = (lo // size + 1) * size
+        # partitions made with another size keep their bounds
+        for _, p_first, p_end in existing:
+            if p_first <= lo < p_end:
+                hi = lo = p_end
+            elif lo < p_first < hi:
+                hi = p_first
+        if lo < hi:
+            partition = '{}_v{}'.format(name, lo)
+            conn.execute('CREATE TABLE {} PARTITION OF {} FOR VALUES FROM ({}) TO ({})'.format(
+                quote(partition), quote(name), lo, hi))
+            logger.info('created partition {} for versions {} to {}'.format(partition, lo, hi - 1))
+            lo = hi
+    covered[name] = (start, end)
+
+
+def rename_partitions(conn, name, old_prefix, new_prefix):
+    # rename the partitions of a renamed table after it, <old_prefix>_v<n> to <new_prefix>_v<n>
+    quote = conn.dialect.identifier_preparer.quote
+    for partition, first, end in list_partitions(conn, name):
+        if partition.startswith(old_prefix + '_v'):
+            conn.execute('ALTER TABLE {} RENAME TO {}'.format(
+                quote(partition), quote(new_prefix + partition[len(old_prefix):])))
+
+
+def detach_partitions(engine, name, before, backup_path):
+    # archive and drop the partitions of a table holding only versions below before
+    # returns the end of the last one, the new first version of the table
+    quote = engine.dialect.identifier_preparer.quote
+    with engine.connect() as conn:
+        old = [p for p in list_partitions(conn, name) if p[2] <= before]
+    floor = None
+    for partition, first, end in old:
+        with engine.begin() as conn:
+            conn.execute('ALTER TABLE {} DETACH PARTITION {}'.format(quote(name), quote(partition)))
+        # a detached partition that fails to archive stays as a table of its own
+        path = '{}_{}.lba'.format(backup_path, partition)
+        rows = dump_table(engine, partition, path)
+        with engine.begin() as conn:
+            conn.execute('DROP TABLE {}'.format(quote(partition)))
+        logger.info('archived {} rows of versions {} to {} to {}'.format(rows, first, end - 1, path))
+        floor = end
+    return floor
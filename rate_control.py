@@ -0,0 +1,62 @@
+# Adaptive batch size and request pacing for fetching from the rpc server
+
+##########
+# Logger #
+##########
+import logging
+logger = logging.getLogger(__name__)
+
+
+###########
+# Imports #
+###########
+from threading import Lock
+
+
+##############
+# Controller #
+##############
+class BatchController:
+    """AIMD controller for the ingestion window.
+
+    While the rpc server answers within the latency target the batch grows by a fixed
+    step and the delay between requests shrinks. On RESOURCE_EXHAUSTED or a slow answer
+    the batch is halved and the delay doubled.
+    """
+    def __init__(self, config):
+        self.min_batch = config['INGEST_BATCH_MIN']
+        self.max_batch = config['INGEST_BATCH_MAX']
+        self.step = config['INGEST_BATCH_STEP']
+        self.min_delay = config['INGEST_DELAY_MIN']
+        self.max_delay = config['INGEST_DELAY_MAX']
+        self.latency_target = config['INGEST_LATENCY_TARGET']
+
+        # start where the fixed settings used to be: 1000 versions, 1ms of sleep per version
+        self.batch = min(max(1000, self.min_batch), self.max_batch)
+        self.delay = min(max(0.001 * self.batch, self.min_delay), self.max_delay)
+        self.lock = Lock()
+
+    def window(self):
+        with self.lock:
+            return self.batch, self.delay
+
+    def completed(self, latency):
+        # a request finished successfully after latency seconds
+        if latency > self.latency_target:
+            logger.info('rpc latency {:.2f}s over target, backing off'.format(latency))
+            self.back_off()
+            return
+        with self.lock:
+            self.batch = min(self.batch + self.step, self.max_batch)
+            self.delay = max(self.delay * 0.9, self.min_delay)
+
+    def throttled(self):
+        # the rpc server answered RESOURCE_EXHAUSTED
+        logger.warning('rpc server is throttling us, backing off')
+        self.back_off()
+
+    def back_off(self):
+        with self.lock:
+            self.batch = max(self.batch // 2, self.min_batch)
+            self.delay = min(self.delay * 2, self.max_delay)
+        logger.info('ingestion window: batch {} delay {:.3f}s'.format(*self.window()))
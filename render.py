@@ -0,0 +1,71 @@
+# Precompiled page templates
+# templates keep their str.format syntax but are split once into static byte chunks and slots
+
+###########
+# Imports #
+###########
+from string import Formatter
+
+
+#############
+# Templates #
+#############
+class Template:
+    """A str.format template compiled into (static bytes, slot) pairs.
+
+    Slots are positional fields, optionally with a conversion and a format spec. A slot
+    value may be bytes (inserted as is), any value accepted by format(), or an iterable of
+    bytes / str chunks such as a generator of table rows.
+    """
+    def __init__(self, text):
+        self.parts = []  # (static bytes, slot index or None, conversion, format spec)
+        auto = 0
+        for literal, field, spec, conv in Formatter().parse(text):
+            if field is None:
+                self.parts.append((literal.encode('utf-8'), None, None, None))
+                continue
+            if field == '':
+                field, auto = str(auto), auto + 1
+            if not field.isdigit() or '{' in spec:
+                raise ValueError('unsupported template field: {{{}}}'.format(field))
+            self.parts.append((literal.encode('utf-8'), int(field), conv, spec))
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'r', encoding='utf-8') as f:
+            return cls(f.read())
+
+    def stream(self, *args):
+        # yields encoded chunks, iterable slot values are passed through chunk by chunk
+        for static, idx, conv, spec in self.parts:
+            if static:
+                yield static
+            if idx is None:
+                continue
+            value = args[idx]
+            if isinstance(value, (bytes, str)) or not hasattr(value, '__iter__'):
+                yield encode(value, conv, spec)
+            else:
+                for chunk in value:
+                    yield encode(chunk, None, '')
+
+    def render(self, *args):
+        # one join at the end instead of growing a string per field
+        return b''.join(self.stream(*args))
+
+
+#########
+# Funcs #
+#########
+def encode(value, conv, spec):
+    if isinstance(value, bytes):
+        return value
+    if conv == 'r':
+        value = repr(value)
+    elif conv == 's':
+        value = str(value)
+    elif conv == 'a':
+        value = ascii(value)
+    if isinstance(value, str) and not spec:
+        return value.encode('utf-8')
+    return format(value, spec).encode('utf-8')
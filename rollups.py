@@ -0,0 +1,198 @@
+# Incrementally maintained per-minute aggregates of the transactions table used for stats
+
+##########
+# Logger #
+##########
+import logging
+logger = logging.getLogger(__name__)
+
+
+###########
+# Imports #
+###########
+import hashlib
+import math
+import zlib
+
+from sqlalchemy import func, and_, or_
+from sqlalchemy.dialects import postgresql
+
+from models import StatsBucket, Transaction
+
+
+###########
+# Globals #
+###########
+ALL_TIME = -1           # bucket key holding the aggregates over the whole table
+HOURS = -(1 << 40)      # hourly buckets are keyed HOURS + expiration_unixtime // 3600, below the minutes and ALL_TIME
+SKETCH_PRECISION = 10   # 2^10 HyperLogLog registers, ~3% error on unique account counts
+SKETCH_SIZE = 1 << SKETCH_PRECISION
+
+TX_TYPES = {'mint_transaction': 'mint', 'peer_to_peer_transaction': 'p2p'}
+ROLLUP_COLUMNS = ('version', 'expiration_unixtime', 'type', 'amount', 'src', 'dest')  # fields read by accumulate
+
+
+############
+# Sketches #
+############
+# HyperLogLog registers for approximate unique account counts
+def sketch_add(registers, item):
+    x = int.from_bytes(hashlib.blake2b(item.encode(), digest_size=8).digest(), 'big')
+    idx = x >> (64 - SKETCH_PRECISION)
+    rest = x & ((1 << (64 - SKETCH_PRECISION)) - 1)
+    rank = (64 - SKETCH_PRECISION) - rest.bit_length() + 1
+    if rank > registers[idx]:
+        registers[idx] = rank
+
+
+def sketch_merge(registers, other):
+    registers[:] = bytes(map(max, registers, other))
+
+
+def sketch_load(blob):
+    return bytearray(zlib.decompress(blob)) if blob else bytearray(SKETCH_SIZE)
+
+
+def sketch_dump(registers):
+    # registers of sparse minutes are mostly zeros so they compress to a few bytes
+    return zlib.compress(bytes(registers))
+
+
+def sketch_count(registers):
+    m = SKETCH_SIZE
+    alpha = 0.7213 / (1 + 1.079 / m)
+    estimate = alpha * m * m / sum(2.0 ** -r for r in registers)
+    zeros = registers.count(0)
+    if estimate <= 2.5 * m and zeros:
+        estimate = m * math.log(m / zeros)  # small range correction
+    return int(round(estimate))
+
+
+###########
+# Rollups #
+###########
+def new_bucket():
+    return {'first_version': None, 'mint_count': 0, 'mint_sum': 0, 'p2p_count': 0, 'p2p_sum': 0,
+            'other_count': 0, 'other_sum': 0, 'src': bytearray(SKETCH_SIZE), 'dest': bytearray(SKETCH_SIZE)}
+
+
+def accumulate(buckets, row):
+    amount = row['amount']
+    kind = TX_TYPES.get(row['type'], 'other')
+    for key in (ALL_TIME, row['expiration_unixtime'] // 60, HOURS + row['expiration_unixtime'] // 3600):
+        b = buckets.get(key)
+        if b is None:
+            b = buckets[key] = new_bucket()
+        if b['first_version'] is None or row['version'] < b['first_version']:
+            b['first_version'] = row['version']
+        b[kind + '_count'] += 1
+        b[kind + '_sum'] += amount
+        sketch_add(b['src'], row['src'])
+        sketch_add(b['dest'], row['dest'])
+
+
+def ensure_all_time(session, model=StatsBucket):
+    # create the empty all time bucket unless it exists, a writer that loses the race waits for the other to commit
+    values = dict(minute=ALL_TIME, mint_count=0, mint_sum=0, p2p_count=0, p2p_sum=0, other_count=0, other_sum=0)
+    if session.connection().dialect.name == 'postgresql':
+        stmt = postgresql.insert(model.__table__).values(**values).on_conflict_do_nothing()
+    else:
+        stmt = model.__table__.insert().values(**values).prefix_with('OR IGNORE')  # sqlite
+    session.execute(stmt)
+
+
+def update_rollups(session, rows, model=StatsBucket):
+    # fold a batch of freshly inserted rows into the stats buckets, in the caller's transaction
+    # model is StatsBucket or a class mapped to its shadow table during a testnet reset
+    buckets = dict()
+    for row in rows:
+        accumulate(buckets, row)
+    if not buckets:
+        return
+
+    # the db worker, the gap repair and restores fold batches in: locking the all time bucket first serialises them,
+    # and the buckets read after it include the ones the other committed meanwhile
+    # it is created beforehand so the lock also holds for the first batch of an empty table
+    ensure_all_time(session, model)
+    session.query(model).filter(model.minute == ALL_TIME).with_for_update().first()
+    existing = {b.minute: b for b in session.query(model).filter(model.minute.in_(list(buckets)))
+                .with_for_update()}
+    for minute, acc in buckets.items():
+        b = existing.get(minute)
+        if b is None:
+            b = model(minute=minute, first_version=acc['first_version'], mint_count=0, mint_sum=0,
+                      p2p_count=0, p2p_sum=0, other_count=0, other_sum=0)
+            session.add(b)
+        else:
+            b.first_version = min(b.first_version, acc['first_version']) if b.first_version is not None \
+                else acc['first_version']
+            sketch_merge(acc['src'], sketch_load(b.src_sketch))
+            sketch_merge(acc['dest'], sketch_load(b.dest_sketch))
+
+        for kind in ('mint', 'p2p', 'other'):
+            setattr(b, kind + '_count', getattr(b, kind + '_count') + acc[kind + '_count'])
+            setattr(b, kind + '_sum', getattr(b, kind + '_sum') + acc[kind + '_sum'])
+        b.src_sketch = sketch_dump(acc['src'])
+        b.dest_sketch = sketch_dump(acc['dest'])
+
+
+def rebuild_rollups(session, batch=10000):
+    # one time backfill for a database that has transactions but no buckets yet
+    if session.query(StatsBucket).first() is not None or session.query(Transaction).first() is None:
+        return
+
+    logger.info('building stats rollups from the transactions table')
+    cols = [getattr(Transaction, name) for name in ROLLUP_COLUMNS]
+    last = -1
+    while True:
+        rows = [r._asdict() for r in session.query(*cols).filter(Transaction.version > last)
+                .order_by(Transaction.version).limit(batch)]
+        if not rows:
+            break
+        update_rollups(session, rows)
+        session.flush()
+        last = rows[-1]['version']
+        logger.info('stats rollups built up to version {}'.format(last))
+
+
+def read_rollups(session, min_minute=None, max_minute=None):
+    # aggregate the buckets of a window, or the all time bucket when no window is given
+    window = lambda q: (q
+        .filter(StatsBucket.minute >= min_minute)
+        .filter(StatsBucket.minute < max_minute)
+    ) if min_minute is not None else q.filter(StatsBucket.minute == ALL_TIME)
+
+    # counts and sums are added up in the database
+    kinds = ('mint', 'p2p', 'other')
+    cols = [func.min(StatsBucket.first_version)]
+    for kind in kinds:
+        cols += [func.sum(getattr(StatsBucket, kind + '_count')), func.sum(getattr(StatsBucket, kind + '_sum'))]
+    totals = window(session.query(*cols)).one()
+
+    res = new_bucket()
+    res['first_version'] = totals[0]
+    # earliest minute with transactions, kept after their rows are pruned
+    minutes = session.query(func.min(StatsBucket.minute)).filter(StatsBucket.minute >= 0)
+    if min_minute is not None:
+        minutes = minutes.filter(StatsBucket.minute >= min_minute).filter(StatsBucket.minute < max_minute)
+    res['first_minute'] = minutes.scalar()
+    for i, kind in enumerate(kinds):
+        res[kind + '_count'] = int(totals[1 + 2*i] or 0)
+        res[kind + '_sum'] = int(totals[2 + 2*i] or 0)
+
+    # sketches are merged register by register, from the hourly buckets of the full hours of the window
+    # and the minutes at its ends: at most 24 + 2 * 59 sketches for a day instead of 1440
+    sketches = session.query(StatsBucket.src_sketch, StatsBucket.dest_sketch)
+    first_hour, end_hour = (-(-min_minute // 60), max_minute // 60) if min_minute is not None else (0, 0)
+    if first_hour < end_hour:
+        sketches = sketches.filter(or_(
+            and_(StatsBucket.minute >= min_minute, StatsBucket.minute < first_hour * 60),
+            and_(StatsBucket.minute >= HOURS + first_hour, StatsBucket.minute < HOURS + end_hour),
+            and_(StatsBucket.minute >= end_hour * 60, StatsBucket.minute < max_minute)))
+    else:
+        sketches = window(sketches)
+    for src_sketch, dest_sketch in sketches:
+        sketch_merge(res['src'], sketch_load(src_sketch))
+        sketch_merge(res['dest'], sketch_load(dest_sketch))
+
+    return res
@@ -13,52 +13,177 @@ logger = logging.getLogger(__name__)
 import grpc
 
 from lib.admission_control_pb2_grpc import AdmissionControlStub
-from lib.get_with_proof_pb2 import UpdateToLatestLedgerRequest, GetAccountStateRequest, \
-    RequestItem, GetTransactionsRequest
+from lib.get_with_proof_pb2 import UpdateToLatestLedgerRequest, UpdateToLatestLedgerResponse, \
+    GetAccountStateRequest, RequestItem, GetTransactionsRequest
 from lib.transaction_pb2 import RawTransaction
 
 import struct
-from hexdump import hexdump
+from scripts import script_hash, split_raw_program
+from columns import hex_column, u64_column, clamp_column, column_rows
 
 import sys
+import random
+from concurrent.futures import Future
 from datetime import datetime
+from itertools import count
+from threading import Event, Lock
+from time import sleep
 
 
 ###########
 # Globals #
 ###########
+RETRY_CODES = (grpc.StatusCode.UNAVAILABLE, grpc.StatusCode.RESOURCE_EXHAUSTED)
+INGEST_RETRY_CODES = (grpc.StatusCode.UNAVAILABLE,)  # ingestion reports RESOURCE_EXHAUSTED to its rate controller
+
 SERVER_ADDRESS = ''
 MINT_ACCOUNT = ''
-stub = None
+client = None
+acct_coalescer = None
 last_version_seen = 0
 
 
+##########
+# Client #
+##########
+class RpcClient:
+    """Pool of keepalive gRPC channels to the admission control service.
+
+    Safe to share between the db worker and the Flask request threads: gRPC channels and
+    stubs are thread safe and the round robin counter is atomic.
+    """
+    def __init__(self, server, pool_size=2, timeout=10.0, retries=3, keepalive_ms=30000, backoff=0.2, backoff_max=5.0):
+        options = [
+            ('grpc.keepalive_time_ms', keepalive_ms),
+            ('grpc.keepalive_timeout_ms', 10000),
+            ('grpc.keepalive_permit_without_calls', 1),
+            ('grpc.http2.max_pings_without_data', 0),
+            ('grpc.max_receive_message_length', 64 * 1024 * 1024),
+            ('grpc.use_local_subchannel_pool', 1),  # one connection per channel instead of a shared one
+        ]
+        self.channels = [grpc.insecure_channel(server, options=options) for _ in range(pool_size)]
+        self.stubs = [AdmissionControlStub(channel) for channel in self.channels]
+        # the same method returning the serialized response, so it can be decoded in another process
+        self.raw_calls = [channel.unary_unary('/admission_control.AdmissionControl/UpdateToLatestLedger',
+                                              request_serializer=UpdateToLatestLedgerRequest.SerializeToString)
+                          for channel in self.channels]
+        self.counter = count()
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.backoff_max = backoff_max
+
+    def update_to_latest_ledger(self, request, timeout=None, raw=False, retry_codes=RETRY_CODES):
+        # every call has a deadline, errors with retry_codes are retried with jittered backoff
+        # raw returns the response as bytes
+        for attempt in range(self.retries + 1):
+            i = next(self.counter) % len(self.stubs)
+            call = self.raw_calls[i] if raw else self.stubs[i].UpdateToLatestLedger
+            try:
+                return call(request, timeout=timeout or self.timeout)
+            except grpc.RpcError as e:
+                if e.code() not in retry_codes or attempt == self.retries:
+                    raise
+                delay = min(self.backoff * 2 ** attempt, self.backoff_max) * random.uniform(0.5, 1.5)
+                logger.warning('rpc call failed with {}, retry {} in {:.2f}s'.format(e.code(), attempt + 1, delay))
+                sleep(delay)
+
+    def close(self):
+        for channel in self.channels:
+            channel.close()
+
+
+class AccountLookupCoalescer:
+    """Merges account lookups arriving within a short window into one batched call.
+
+    The first caller of a batch waits for the window (or until the batch is full) and
+    runs the lookup for everyone, the other callers wait on their futures.
+    """
+    def __init__(self, lookup_many, window=0.005, max_batch=32):
+        self.lookup_many = lookup_many
+        self.window = window
+        self.max_batch = max_batch
+        self.lock = Lock()
+        self.futures = None  # acct -> Future for the batch being collected
+        self.full = None     # set when that batch reached max_batch
+
+    def get(self, acct, timeout=None):
+        with self.lock:
+            leader = self.futures is None
+            if leader:
+                self.futures, self.full = dict(), Event()
+            futures, full = self.futures, self.full
+
+            fut = futures.get(acct)
+            if fut is None:
+                fut = futures[acct] = Future()
+                if len(futures) >= self.max_batch:
+                    self.futures = None  # later callers start a new batch
+                    full.set()
+
+        if leader:
+            full.wait(self.window)
+            with self.lock:
+                if self.futures is futures:
+                    self.futures = None
+            self.run(futures)
+
+        return fut.result(timeout)
+
+    def run(self, futures):
+        accts = list(futures)
+        logger.debug('coalesced lookup of {} accounts'.format(len(accts)))
+        try:
+            results = self.lookup_many(accts)
+        except Exception as e:
+            for fut in futures.values():
+                fut.set_exception(e)
+            return
+
+        for acct, res in zip(accts, results):
+            futures[acct].set_result(res)
+
+
 #########
 # Funcs #
 #########
-def start_rpc_client_instance(rpc_server, mint_addr):
+def start_rpc_client_instance(config):
     global last_version_seen
-    global stub
+    global client
+    global acct_coalescer
     global SERVER_ADDRESS
     global MINT_ACCOUNT
 
-    SERVER_ADDRESS = rpc_server
-    MINT_ACCOUNT = mint_addr
+    SERVER_ADDRESS = config['RPC_SERVER']
+    MINT_ACCOUNT = config['MINT_ACCOUNT']
 
-    channel = grpc.insecure_channel(SERVER_ADDRESS)
-    stub = AdmissionControlStub(channel)
+    if client:
+        client.close()
+    client = RpcClient(SERVER_ADDRESS, pool_size=config['RPC_POOL_SIZE'], timeout=config['RPC_TIMEOUT'],
+                       retries=config['RPC_RETRIES'], keepalive_ms=config['RPC_KEEPALIVE_MS'])
+    acct_coalescer = AccountLookupCoalescer(get_acct_raw_many, window=config['ACCT_COALESCE_MS'] / 1000,
+                                            max_batch=config['ACCT_COALESCE_MAX'])
 
     last_version_seen = get_latest_version_from_ledger()
 
-    return stub
+    return client
+
+
+def wait_for_rpc_client_instance(config):
+    # keep trying until the rpc server answers
+    while True:
+        try:
+            return start_rpc_client_instance(config)
+        except:
+            logger.warning('rpc server {} not reachable, retrying'.format(config['RPC_SERVER']))
+            sleep(1)
 
 
 def get_latest_version_from_ledger():
     global last_version_seen
-    global stub
 
     request = UpdateToLatestLedgerRequest(client_known_version=last_version_seen, requested_items=[])
-    response = stub.UpdateToLatestLedger(request)
+    response = client.update_to_latest_ledger(request)
     ledger_info = response.ledger_info_with_sigs.ledger_info
 
     last_version_seen = ledger_info.version
@@ -66,16 +191,23 @@ def get_latest_version_from_ledger():
     return last_version_seen
 
 
+def get_acct_raw_many(accts):
+    # one round trip for many accounts, responses come back in request order
+    items = [RequestItem(get_account_state_request=GetAccountStateRequest(address=bytes.fromhex(acct)))
+             for acct in accts]
+    request = UpdateToLatestLedgerRequest(client_known_version=last_version_seen, requested_items=items)
+    response = client.update_to_latest_ledger(request)
+
+    return [item.get_account_state_response for item in response.response_items]
+
+
 def get_acct_raw(acct):
-    global last_version_seen
-    global stub
+    return get_acct_raw_many([acct])[0]
 
-    account = GetAccountStateRequest(address=bytes.fromhex(acct))
-    item = RequestItem(get_account_state_request=account)
-    request = UpdateToLatestLedgerRequest(client_known_version=last_version_seen, requested_items=[item])
-    response = stub.UpdateToLatestLedger(request)
 
-    return response.response_items[0].get_account_state_response
+def get_acct_raw_coalesced(acct):
+    # concurrent lookups from request threads share a single round trip
+    return acct_coalescer.get(acct, timeout=client.timeout * (client.retries + 1))
 
 
 def get_acct_info(state):
@@ -96,15 +228,24 @@ def get_acct_info(state):
     return account, balance, sq_num, sent_events, recv_events, delegated_withdrawal_cap
 
 
-def get_raw_tx_lst(version, limit):
-    global last_version_seen
-    global stub
-
-    tx_req = GetTransactionsRequest(start_version=version, limit=limit, fetch_events=True)
+def tx_lst_request(version, limit, fetch_events):
+    tx_req = GetTransactionsRequest(start_version=version, limit=limit, fetch_events=fetch_events)
     item = RequestItem(get_transactions_request=tx_req)
-    request = UpdateToLatestLedgerRequest(client_known_version=last_version_seen, requested_items=[item])
-    response = stub.UpdateToLatestLedger(request)
+    return UpdateToLatestLedgerRequest(client_known_version=last_version_seen, requested_items=[item])
+
 
+def get_raw_tx_lst(version, limit, fetch_events=True, retry_codes=RETRY_CODES):
+    response = client.update_to_latest_ledger(tx_lst_request(version, limit, fetch_events), retry_codes=retry_codes)
+    return unpack_tx_lst(response)
+
+
+def get_raw_tx_bytes(version, limit, fetch_events=True, retry_codes=RETRY_CODES):
+    # the serialized response, for decode_tx_bytes in a decoder process
+    return client.update_to_latest_ledger(tx_lst_request(version, limit, fetch_events), raw=True,
+                                          retry_codes=retry_codes)
+
+
+def unpack_tx_lst(response):
     infos = response.response_items[0].get_transactions_response.txn_list_with_proof.infos
     raw = response.response_items[0].get_transactions_response.txn_list_with_proof
     events = response.response_items[0].get_transactions_response.txn_list_with_proof.events_for_versions
@@ -118,37 +259,109 @@ def get_raw_tx_lst(version, limit):
     return tx_struct, infos, raw, events
 
 
-def parse_raw_tx_lst(struct_lst, infos, raw, events):
-    cur_ver = raw.first_transaction_version.value
-    res = []
+def parse_tx_columns(struct_lst, infos, raw, events, light=False):
+    # decode a batch column by column, light skips the program fields (script_hash and program_args are None)
+    n = min(len(struct_lst), len(infos), len(raw.transactions))
+    struct_lst, infos, signed = struct_lst[:n], infos[:n], raw.transactions[:n]
+    first = raw.first_transaction_version.value
+    programs = [tx.program for tx in struct_lst]
+    expirations = [tx.expiration_time for tx in struct_lst]
+
+    dates = {}  # expiration times repeat within a batch
+    for t in expirations:
+        if t not in dates:
+            dates[t] = str(datetime.fromtimestamp(min(t, 2147485547)))
+
+    cols = dict()
+    cols['version'] = list(range(first, first + n))
+    cols['expiration_date'] = [dates[t] for t in expirations]
+    cols['src'] = hex_column([tx.sender_account for tx in struct_lst])
+    cols['dest'] = hex_column([p.arguments[0].data for p in programs])
+    cols['type'] = ['peer_to_peer_transaction' if src != MINT_ACCOUNT else 'mint_transaction' for src in cols['src']]
+    cols['amount'] = u64_column([p.arguments[1].data for p in programs])
+    cols['gas_price'] = clamp_column([tx.gas_unit_price for tx in struct_lst])
+    cols['max_gas'] = clamp_column([tx.max_gas_amount for tx in struct_lst])
+    cols['sq_num'] = [tx.sequence_number for tx in struct_lst]
+    cols['pub_key'] = hex_column([r.sender_public_key for r in signed])
+    cols['expiration_unixtime'] = clamp_column(expirations)
+    cols['gas_used'] = clamp_column([info.gas_used for info in infos])
+    cols['sender_sig'] = hex_column([r.sender_signature for r in signed])
+    cols['signed_tx_hash'] = hex_column([info.signed_transaction_hash for info in infos])
+    cols['state_root_hash'] = hex_column([info.state_root_hash for info in infos])
+    cols['event_root_hash'] = hex_column([info.event_root_hash for info in infos])
+
+    if not light:
+        hashes = {}  # most transactions share the same script
+        cols['script_hash'], cols['program_args'] = [], []
+        for r in signed:
+            code, args = split_raw_program(r.raw_txn_bytes)
+            if code not in hashes:
+                hashes[code] = script_hash(code)
+            cols['script_hash'].append(hashes[code])
+            cols['program_args'].append(args)
+    else:
+        cols['script_hash'] = cols['program_args'] = [None] * n
+
+    return cols
+
+
+def parse_raw_tx_lst(struct_lst, infos, raw, events, light=False):
+    # one dict per transaction, see parse_tx_columns
+    return list(column_rows(parse_tx_columns(struct_lst, infos, raw, events, light)))
+
+
+def parse_scripts(struct_lst):
+    # script hash -> code of the programs of a batch
+    return {script_hash(code): code for code in {tx.program.code for tx in struct_lst}}
+
+
+def decode_tx_data(tx_data, light=False):
+    # (transaction columns, event columns, scripts) of the result of get_raw_tx_lst
+    scripts = parse_scripts(tx_data[0]) if not light else {}
+    return parse_tx_columns(*tx_data, light=light), parse_event_columns(tx_data[2], tx_data[3]), scripts
+
+
+def init_decoder(mint_account):
+    # initializer of the decoder processes, they never open an rpc client
+    global MINT_ACCOUNT
+    MINT_ACCOUNT = mint_account
+
 
-    for (info, tx, r) in zip(infos, struct_lst, raw.transactions): #, events):
-        tmp = dict()
+def decode_tx_bytes(data, light=False):
+    # decode_tx_data of the bytes of get_raw_tx_bytes, runs in a decoder process
+    return decode_tx_data(unpack_tx_lst(UpdateToLatestLedgerResponse.FromString(data)), light)
 
-        tmp['version'] = cur_ver
+
+def get_tx_program(version):
+    # Program of a single transaction, for rows not backfilled yet after light ingestion
+    # None when the ledger does not have the version: pruned, reset or not yet available
+    txs = get_raw_tx_lst(version, 1, fetch_events=False)[0]
+    return txs[0].program if txs else None
+
+
+def parse_event_columns(raw, events):
+    # events table columns, events_for_version holds one list per transaction of raw
+    cur_ver = raw.first_transaction_version.value
+    versions, indexes, lst = [], [], []
+
+    for event_list in events.events_for_version:
+        for (i, event) in enumerate(event_list.events):
+            versions.append(cur_ver)
+            indexes.append(i)
+            lst.append(event)
         cur_ver += 1
 
-        tmp['expiration_date'] = str(datetime.fromtimestamp(min(tx.expiration_time, 2147485547)))
-        tmp['src'] = bytes.hex(tx.sender_account)
-        tmp['dest'] = bytes.hex(tx.program.arguments[0].data)
-        tmp['type'] = 'peer_to_peer_transaction' if tmp['src'] != MINT_ACCOUNT else 'mint_transaction'
-        tmp['amount'] = tx.program.arguments[1].data
-        tmp['gas_price'] = struct.pack("<Q", tx.gas_unit_price)
-        tmp['max_gas'] = struct.pack("<Q", tx.max_gas_amount)
-        tmp['sq_num'] = tx.sequence_number
-        tmp['pub_key'] = bytes.hex(r.sender_public_key)
-        tmp['expiration_unixtime'] = min(tx.expiration_time, 2**63 - 1)
-
-        tmp['gas_used'] = struct.pack("<Q", info.gas_used)
-
-        tmp['sender_sig'] = bytes.hex(r.sender_signature)
-        tmp['signed_tx_hash'] = bytes.hex(info.signed_transaction_hash)
-        tmp['state_root_hash'] = bytes.hex(info.state_root_hash)
-        tmp['event_root_hash'] = bytes.hex(info.event_root_hash)
-        tmp['code_hex'] = hexdump(tx.program.code, result='return')
-        tmp['program'] = str(tx.program)
-        #tmp['events'] = events
-
-        res.append(tmp)
-
-    return res
+    access_paths = [event.access_path for event in lst]
+    return {
+        'version': versions,
+        'event_index': indexes,
+        'address': hex_column([p.address for p in access_paths]),
+        'path': hex_column([p.path for p in access_paths]),
+        'sequence_number': clamp_column([event.sequence_number for event in lst]),
+        'data': hex_column([event.event_data for event in lst]),
+    }
+
+
+def parse_events(raw, events):
+    # one dict per event, see parse_event_columns
+    return list(column_rows(parse_event_columns(raw, events)))
@@ -0,0 +1,97 @@
+# Program code deduplicated by hash, rendered lazily for /version
+
+###########
+# Imports #
+###########
+import hashlib
+from functools import lru_cache
+
+from hexdump import hexdump
+
+from lib.transaction_pb2 import Program
+
+
+###########
+# Globals #
+###########
+SCRIPT_CACHE_SIZE = 256  # testnet traffic uses a handful of distinct scripts
+RAW_TX_PROGRAM = 3  # field numbers in transaction.proto
+PROGRAM_CODE = 1
+
+
+#########
+# Funcs #
+#########
+def script_hash(code):
+    return hashlib.sha256(code).hexdigest()
+
+
+def split_program(program):
+    # (script hash, code, serialized arguments and modules) of a Program
+    args = Program(arguments=program.arguments, modules=program.modules).SerializeToString()
+    return script_hash(program.code), program.code, args
+
+
+def read_varint(buf, pos):
+    result = shift = 0
+    while True:
+        b = buf[pos]
+        pos += 1
+        result |= (b & 0x7f) << shift
+        if b < 0x80:
+            return result, pos
+        shift += 7
+
+
+def message_fields(buf):
+    # (field number, start of the field, start of the value, end) of a serialized message
+    pos = 0
+    while pos < len(buf):
+        start = pos
+        key, pos = read_varint(buf, pos)
+        wire_type = key & 7
+        if wire_type == 0:
+            _, end = read_varint(buf, pos)
+        elif wire_type == 1:
+            end = pos + 8
+        elif wire_type == 2:
+            size, pos = read_varint(buf, pos)
+            end = pos + size
+        elif wire_type == 5:
+            end = pos + 4
+        else:
+            raise ValueError('unsupported wire type {}'.format(wire_type))
+        yield key >> 3, start, pos, end
+        pos = end
+
+
+def split_raw_program(raw_txn_bytes):
+    # (code, serialized arguments and modules) of a serialized RawTransaction, without parsing it
+    # the same as split_program but without building protobuf objects
+    program = b''
+    for field, start, value, end in message_fields(raw_txn_bytes):
+        if field == RAW_TX_PROGRAM:
+            program = raw_txn_bytes[value:end]
+            break
+
+    code = b''
+    args = []
+    for field, start, value, end in message_fields(program):
+        if field == PROGRAM_CODE:
+            code = program[value:end]
+        else:
+            args.append(program[start:end])
+    return code, b''.join(args)
+
+
+@lru_cache(maxsize=SCRIPT_CACHE_SIZE)
+def render_script(hash, code):
+    # hexdump and text of the code, memoised per script
+    return hexdump(code, result='return'), str(Program(code=code))
+
+
+def render_program(hash, code, program_args):
+    # code_hex and program text as they used to be stored per transaction
+    # text format prints fields in order, so the code and the arguments can be rendered apart
+    code_hex, code_text = render_script(hash, code)
+    return code_hex, code_text + str(Program.FromString(program_args or b''))
@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Production entry point: the indexer process plus a pool of multi-threaded web workers
+# execute with: nohup python3 serve.py &> browser.log < /dev/null &
+
+################
+# Logging init #
+################
+import json
+from logging.config import dictConfig
+
+with open('logging.json', 'r') as f:
+    dictConfig( json.load(f) )
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+###########
+# Imports #
+###########
+import argparse
+import atexit
+import os
+import subprocess
+import sys
+
+from settings import load_config
+
+try:
+    from gunicorn.app.base import BaseApplication
+except ImportError:
+    BaseApplication = object  # falls back to the threaded development server below
+
+
+###############
+# Application #
+###############
+class BrowserApplication(BaseApplication):
+    """Runs Browser.app under gunicorn with N worker processes of M threads each."""
+    def __init__(self, options):
+        self.options = options
+        super().__init__()
+
+    def load_config(self):
+        for key, value in self.options.items():
+            self.cfg.set(key, value)
+
+    def load(self):
+        # imported after the fork so every worker has its own grpc channels and db connections
+        from Browser import app
+        return app
+
+
+def post_worker_init(worker):
+    from Browser import init_services
+    init_services()
+
+
+########
+# Main #
+########
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='serve LibraBrowser with multiple web workers')
+    parser.add_argument('--no-indexer', action='store_true', help='serve only, python3 -m indexer runs elsewhere')
+    args = parser.parse_args()
+
+    config = load_config()
+
+    # exactly one ingestion process, started fresh so it shares no grpc or db state with the web workers
+    if not args.no_indexer:
+        indexer = subprocess.Popen([sys.executable, '-m', 'indexer'])
+        master_pid = os.getpid()
+
+        def stop_indexer():
+            # forked web workers inherit atexit handlers, only the master owns the indexer
+            if os.getpid() == master_pid:
+                indexer.terminate()
+        atexit.register(stop_indexer)
+        logger.info('indexer process started, pid {}'.format(indexer.pid))
+
+    if BaseApplication is object:
+        logger.warning('gunicorn is not installed, serving with the threaded development server')
+        from Browser import app, init_services
+        init_services()
+        app.run(port=config['FLASK_PORT'], threaded=True, host=config['FLASK_HOST'], debug=False)
+    else:
+        BrowserApplication({
+            'bind': '{}:{}'.format(config['FLASK_HOST'], config['FLASK_PORT']),
+            'workers': config['SERVER_WORKERS'],
+            'threads': config['SERVER_THREADS'],
+            'worker_class': 'gthread',
+            'timeout': config['SERVER_TIMEOUT'],
+            'post_worker_init': post_worker_init,
+        }).run()
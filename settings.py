@@ -0,0 +1,21 @@
+# Configuration loading shared by the browser and the command line tools
+
+###########
+# Imports #
+###########
+import json
+import os
+
+
+#########
+# Funcs #
+#########
+def load_config(path='config.json'):
+    # pick the section named by the BROWSER environment variable, PRODUCTION by default
+    with open(path, 'r') as f:
+        config = json.load(f)
+
+    try:
+        return config[os.getenv("BROWSER")]
+    except:
+        return config["PRODUCTION"]
@@ -0,0 +1,15 @@
+from columns import hex_column
+
+
+def test_hex_column_same_length():
+    assert hex_column([b'\x01\x02', b'\x03\x04']) == ['0102', '0304']
+
+
+def test_hex_column_mixed_lengths():
+    # the total length matches len(values[0]) * n, the values still differ
+    assert hex_column([b'\x01\x02', b'\x03', b'\x04\x05\x06']) == ['0102', '03', '040506']
+    assert hex_column([b'', b'\x01', b'']) == ['', '01', '']
+
+
+def test_hex_column_empty():
+    assert hex_column([]) == []